@@ -1,61 +1,123 @@
+import argparse
 import json
-import openai
 import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import groupby
+
+from sqlalchemy import String, func, or_, select, tuple_
+from sqlalchemy.dialects.postgresql import insert
 
 from app.database import DatabaseManager, Conversation, Summary
+from app.database.writer import RowBuffer
 from app.chatbot.prompts import DefaultPrompts
-from app.config import settings
+from app.core import openai_client
 from app.core.logger import get_logger
 
 logger = get_logger(__name__)
 
-openai.api_key = settings.OPENAI_API_KEY
+# Conversations are loaded in pages and their summaries extracted concurrently, summaries are written in batches
+PAGE_SIZE = 500
+WORKERS = 8
+SUMMARY_BATCH_SIZE = 50
 
 db_manager = DatabaseManager()
 db_session = db_manager.create_session()
 
-def list_conversations(session, all_conversations=True):
-    query = session.query(Conversation.conversation_id,
-                          Conversation.user_id).distinct()
-    # TODO: implement filter
-    if not all_conversations:
-        query = query.filter(...)
+# Format the messages of a conversation as chat history
+def format_conversation(messages):
+    conversation_str = ""
+    for msg in messages:
+        if msg.user_msg:
+            conversation_str += f"user: {msg.user_msg}\n"
 
-    return query.all()
+        if msg.bot_msg:
+            conversation_str += f"assistant: {msg.bot_msg}\n"
+    return conversation_str
+
+
+# Load a page of conversations with all their messages in one query, ordered by the time of their first message.
+# The next page starts after the (started_at, conversation_id) of the last conversation of the previous page.
+# With stale_only, only conversations with messages newer than their summary are loaded.
+def load_conversations(session, limit=None, after=None, stale_only=False):
+    started = (select(Conversation.conversation_id, func.min(Conversation.created_at).label("started_at"))
+               .group_by(Conversation.conversation_id))
+    if stale_only:
+        started = (started.outerjoin(Summary, Summary.conversation_id == Conversation.conversation_id)
+                   .group_by(Summary.summarized_until)
+                   .having(or_(Summary.summarized_until.is_(None),
+                               func.max(Conversation.created_at) > Summary.summarized_until)))
+    if after is not None:
+        started = started.having(tuple_(func.min(Conversation.created_at), Conversation.conversation_id)
+                                 > tuple_(*after))
+    started = started.order_by("started_at", Conversation.conversation_id).limit(limit).subquery()
+
+    rows = session.execute(
+        select(Conversation, started.c.started_at)
+        .join(started, Conversation.conversation_id == started.c.conversation_id)
+        .order_by(started.c.started_at, Conversation.conversation_id, Conversation.created_at)
+    ).all()
+
+    conversations = []
+    for conversation_id, group in groupby(rows, key=lambda row: row[0].conversation_id):
+        group = list(group)
+        messages = [row[0] for row in group]
+        conversations.append({
+            "user_id": messages[0].user_id,
+            "conversation_id": conversation_id,
+            "started_at": group[0][1],
+            "latest_at": messages[-1].created_at,
+            "conversation_str": format_conversation(messages),
+        })
+    return conversations
+
+
+# Iterate over the conversations in pages of up to page_size conversations
+def iter_pages(session, page_size=PAGE_SIZE, stale_only=False):
+    after = None
+    while True:
+        page = load_conversations(session, limit=page_size, after=after, stale_only=stale_only)
+        if page:
+            yield page
+        if len(page) < page_size:
+            return
+        after = (page[-1]["started_at"], page[-1]["conversation_id"])
+
+
+# Iterate over all conversations page by page
+def iter_conversations(session, page_size=PAGE_SIZE, stale_only=False):
+    for page in iter_pages(session, page_size, stale_only):
+        yield from page
 
 
 def fetch_conversation(session, conversation_id):
-    conversations = [c[0] for c in list_conversations(session)]
-
-    if conversation_id not in conversations:
-        logger.error("Conversation not found")
-        return
-
     conversation = (session.query(Conversation)
                     .filter(Conversation.conversation_id == conversation_id)
                     .order_by(Conversation.created_at)
                     .all())
 
-    conversation_str = ""
-
-    for msg in conversation:
-        if msg.user_msg:
-            conversation_str += f"user: {msg.user_msg}\n"
-
-        if msg.bot_msg:
-            conversation_str += f"assistant: {msg.bot_msg}\n"
+    if not conversation:
+        logger.error("Conversation not found")
+        return
 
     return {
         "user_id": conversation[0].user_id,
         "conversation_id": conversation_id,
-        "conversation_str": conversation_str
+        "conversation_str": format_conversation(conversation)
     }
 
 
+# Cut a value to the length of its column
+def truncate_value(column, value):
+    if isinstance(column.type, String) and column.type.length and len(value) > column.type.length:
+        return value[:column.type.length]
+    return value
+
+
 def create_response(conversation):
     schema = DefaultPrompts.summary_schema()
     schema["required"] = ["name", "email", "phone", "company", "company_size", "industry", "role", "interest", "pain", "budget", "additional_info"]
-    completion = openai.ChatCompletion.create(
+    completion = openai_client.chat_completion(
         model="gpt-3.5-turbo-16k",
         messages=[
             {"role": "system", "content": f"CONVERSATION HISTORY: '{conversation['conversation_str']}"},
@@ -76,17 +138,81 @@ def create_response(conversation):
 
     # reorder keys to match schema
     result = {k: result[k] for k in schema["required"]}
+    # Values of the LLM may be of any type and length, store them as strings that fit their columns
+    for key in schema["required"]:
+        if result[key] is not None:
+            result[key] = truncate_value(Summary.__table__.columns[key], str(result[key]))
     result['conversation_id'] = conversation['conversation_id']
     result['user_id'] = conversation['user_id']
-    result['created_at'] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-    return Summary(**result)
+    result['created_at'] = datetime.datetime.now()
+    # Watermark: the summary covers all messages up to the latest loaded one
+    result['summarized_until'] = conversation['latest_at']
+
+    return result
+
+
+# Insert or update summary rows in one statement. A failed batch is retried row by row, returns the number
+# of rows that could not be written.
+def write_summaries(rows):
+    if not rows:
+        return 0
+    statement = insert(Summary)
+    statement = statement.on_conflict_do_update(
+        index_elements=[Summary.conversation_id],
+        set_={column: statement.excluded[column] for column in rows[0] if column != "conversation_id"},
+    )
+    buffer = RowBuffer(Summary, batch_size=len(rows), max_rows=len(rows))
+    for row in rows:
+        buffer.add(row)
+    while len(buffer):
+        batch = buffer.next_batch()
+        try:
+            with db_manager.engine.begin() as connection:
+                connection.execute(statement, batch)
+        except Exception as error:
+            if not buffer.done(batch, error):
+                break
+            continue
+        buffer.done(batch)
+    logger.info(f"Wrote {buffer.written} of {len(rows)} summaries")
+    return len(rows) - buffer.written
+
+
+# Extract the lead data of all conversations with new messages since their last summary. Summaries are committed
+# in batches together with their watermark, so an interrupted run continues with the remaining conversations.
+def summarize_conversations(session, workers=WORKERS, batch_size=SUMMARY_BATCH_SIZE, full=False):
+    start = time.perf_counter()
+    summarized, failed = 0, 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for page in iter_pages(session, stale_only=not full):
+            futures = {executor.submit(create_response, conversation): conversation for conversation in page}
+            batch = []
+            for future in as_completed(futures):
+                try:
+                    batch.append(future.result())
+                except Exception as e:
+                    # The watermark is not advanced, the conversation is retried by the next run
+                    failed += 1
+                    logger.error(f"Unable to extract data for {futures[future]['conversation_id']}: {e}")
+                    continue
+                if len(batch) >= batch_size:
+                    unwritten = write_summaries(batch)
+                    summarized += len(batch) - unwritten
+                    failed += unwritten
+                    batch = []
+            unwritten = write_summaries(batch)
+            summarized += len(batch) - unwritten
+            failed += unwritten
+    logger.info(f"Summarized {summarized} conversations ({failed} failed) in {time.perf_counter() - start:.0f} s")
+    return summarized, failed
 
 
 if __name__ == "__main__":
-
-    for convo in list_conversations(db_session, all_conversations=True):
-        conversation = fetch_conversation(db_session, convo[0])
-        response = create_response(conversation)
-        logger.info(f"Writing to database: {response}")
-        db_manager.write_to_db(response)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Extract lead data from the recorded conversations")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="Number of concurrent extractions")
+    parser.add_argument("--batch-size", type=int, default=SUMMARY_BATCH_SIZE, help="Summaries written per statement")
+    parser.add_argument("--full", action="store_true", help="Re-extract all conversations, not only those with new messages")
+    args = parser.parse_args()
+
+    summarize_conversations(db_session, args.workers, args.batch_size, args.full)
+    db_session.close()
@@ -1,23 +1,37 @@
+import asyncio
 import datetime
+import functools
+import json
+import time
 import uuid
 import os
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
-from starlette.responses import FileResponse
+from starlette.concurrency import iterate_in_threadpool
+from starlette.responses import FileResponse, StreamingResponse
 
 import uvicorn
 import requests
 from pydantic import BaseModel
 
-from app.chatbot import Chatbot
-from app.database import DatabaseManager, Conversation
+from app.api.dispatcher import MessageDispatcher
+from app.chatbot import SessionManager
+from app.chatbot.retrieval_chatbot import answer_cache, embedding_cache
+from app.database import AsyncDatabaseManager
 from app.config import settings
+from app.core import openai_client
 from app.core.logger import get_logger
+from app.core.metrics import LatencyStats
 
 logger = get_logger(__name__)
-bot = Chatbot()
-db_manager = DatabaseManager()
+# Key prefix of the conversations of the browser stream endpoint, in sessions and in the database
+BROWSER_SESSION_PREFIX = "browser:"
+db_manager = AsyncDatabaseManager()
+sessions = SessionManager(db_manager)
+# Time to first token and total time of streamed answers
+stream_ttft = LatencyStats()
+stream_total = LatencyStats()
 
 
 class Papercups:
@@ -26,15 +40,16 @@ class Papercups:
         self.token = token
 
     # Define send_message() function to send reply to Papercups
-    def send_message(self, params):
+    async def send_message(self, params):
         if not self.token:
             logger.error("send_message() : Invalid token!")
             raise HTTPException(status_code=400, detail="Invalid token!")
 
         headers = {'Authorization': f'Bearer {self.token}'}
+        bot = await sessions.aget(params["conversation_id"])
         result = {
             "conversation_id": params["conversation_id"],
-            "body": bot.chat(params["body"])
+            "body": await dispatcher.run_blocking(bot.chat, params["body"])
         }
         # Data to be written to database
         data_dict = {
@@ -46,15 +61,16 @@ class Papercups:
             "created_at": datetime.datetime.utcnow()
         }
 
-        # Write data to database
-        conversation_data = Conversation(**data_dict)
-        db_manager.write_to_db(conversation_data)
+        # Write data to database in the background
+        db_manager.queue_conversation(data_dict)
 
         # Send reply to Papercups
-        requests.post(f"{settings.BASE_URL}/api/v1/messages", headers=headers, json={'message': result})
+        await dispatcher.run_blocking(functools.partial(
+            requests.post, f"{settings.BASE_URL}/api/v1/messages", headers=headers, json={'message': result}))
 
 
 papercups = Papercups(settings.PAPERCUPS_API_KEY)
+dispatcher = MessageDispatcher(papercups.send_message)
 app = FastAPI()
 
 origins = ["http://localhost:3000"]
@@ -73,6 +89,20 @@ class Item(BaseModel):
     event: str
     payload: object
 
+# Start and stop the background workers answering incoming messages
+@app.on_event("startup")
+async def startup():
+    await db_manager.start()
+    await dispatcher.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await dispatcher.stop()
+    await openai_client.aclose()
+    openai_client.close()
+    # Write the buffered conversation rows before the process exits
+    await db_manager.close()
+
 # Define route for root to test chatbot in browser
 @app.get("/")
 async def root():
@@ -89,7 +119,12 @@ async def webhook(item: Item):
     # Handle incoming messages from leads
     elif item.event == "message:created" and item.payload["customer_id"]:
         logger.info(f'New message from {item.payload["customer_id"]}')
-        papercups.send_message(item.payload)
+        # Answer in the background and acknowledge the webhook immediately
+        try:
+            dispatcher.submit(item.payload["conversation_id"], item.payload)
+        except asyncio.QueueFull:
+            logger.error(f'Queue full, rejected message from {item.payload["customer_id"]}')
+            raise HTTPException(status_code=503, detail="Too many pending messages", headers={"Retry-After": "5"})
         return {'ok': True}
     # Check that answer was sent to lead
     elif item.event == "message:created" and item.payload["user_id"]:
@@ -102,6 +137,68 @@ async def webhook(item: Item):
     else:
         raise HTTPException(status_code=400, detail="Invalid event or payload")
 
+# Format a server-sent event
+def sse_event(data, event=None):
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+
+# Stream the answer of the chatbot and store the message once the answer is complete. The endpoint is not
+# authenticated, its conversations are kept apart from the Papercups conversations by a key prefix.
+async def stream_answer(conversation_id, user_id, message):
+    session_id = f"{BROWSER_SESSION_PREFIX}{conversation_id}"
+    start = time.perf_counter()
+    tokens = []
+    try:
+        bot = await sessions.aget(session_id)
+        # The chatbot is blocking, Starlette iterates it in the thread pool
+        async for token in iterate_in_threadpool(bot.chat_stream(message)):
+            if not tokens:
+                stream_ttft.observe(time.perf_counter() - start)
+            tokens.append(token)
+            yield sse_event({"token": token})
+    except Exception as e:
+        logger.error(f"Unable to stream answer for conversation {conversation_id}: {e}")
+        yield sse_event({"detail": "Unable to generate answer"}, event="error")
+        return
+
+    elapsed = time.perf_counter() - start
+    stream_total.observe(elapsed)
+    logger.info(f"Streamed answer for conversation {conversation_id} in {elapsed * 1000:.0f} ms")
+    yield sse_event({"conversation_id": conversation_id}, event="done")
+
+    db_manager.queue_conversation({
+        "id": str(uuid.uuid4()),
+        "user_id": user_id,
+        "conversation_id": session_id,
+        "user_msg": message,
+        "bot_msg": "".join(tokens),
+        "created_at": datetime.datetime.utcnow(),
+    })
+
+# Define route to stream answers token by token as server-sent events
+@app.get("/chat/stream")
+async def chat_stream(message: str,
+                      # Prefixed ids must fit the conversation_id key of the summaries table
+                      conversation_id: str = Query(..., max_length=64 - len(BROWSER_SESSION_PREFIX)),
+                      user_id: str = "browser"):
+    return StreamingResponse(
+        stream_answer(conversation_id, user_id, message),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# Define route to monitor the webhook workers
+@app.get("/metrics")
+async def metrics():
+    return {
+        "dispatcher": dispatcher.metrics(),
+        "sessions": len(sessions),
+        "stream": {"ttft": stream_ttft.summary(), "total": stream_total.summary()},
+        "embedding_cache": embedding_cache.stats(),
+        "answer_cache": answer_cache.stats() if answer_cache is not None else None,
+    }
+
 if __name__ == "__main__":
     os.environ["APP_PATH"] = "../.."
     uvicorn.run(app, host="0.0.0.0", port=8000)
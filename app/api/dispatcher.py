@@ -0,0 +1,111 @@
+import asyncio
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from app.config import settings
+from app.core.logger import get_logger
+from app.core.metrics import LatencyStats
+
+logger = get_logger(__name__)
+
+
+# Process incoming messages in background workers so that webhooks can be acknowledged immediately.
+# Messages of a conversation are answered in order, one at a time. Any free worker picks up the next
+# conversation with waiting messages, so a slow answer only delays its own conversation.
+# The handler is either blocking or a coroutine function that offloads blocking work with run_blocking().
+class MessageDispatcher:
+
+    def __init__(self, handler, workers=settings.WEBHOOK_WORKERS, queue_size=settings.WEBHOOK_QUEUE_SIZE):
+        self.handler = handler
+        self.workers = workers
+        self.queue_size = queue_size
+        self.capacity = workers * queue_size
+        self.executor = None
+        # Waiting messages by conversation. A conversation is in the ready queue or being answered
+        # as long as it is in pending.
+        self.pending = {}
+        self.queued = 0
+        self.ready = None
+        self.tasks = []
+        self.rejected = 0
+        self.failed = 0
+        self.wait_time = LatencyStats()
+        self.processing_time = LatencyStats()
+
+    # Start the worker tasks, must be called from the running event loop
+    async def start(self):
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="webhook-worker")
+        self.ready = asyncio.Queue()
+        self.tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+        logger.info(f"Started {self.workers} webhook workers")
+
+    # Wait for queued messages to be answered, then stop the workers
+    async def stop(self, timeout=settings.WEBHOOK_SHUTDOWN_TIMEOUT):
+        try:
+            await asyncio.wait_for(self.ready.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"Shutdown with {self.queue_depth()} unanswered messages")
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.executor.shutdown(wait=True)
+
+    # Enqueue a message, raises asyncio.QueueFull if the workers or the conversation are saturated
+    def submit(self, conversation_id, payload):
+        messages = self.pending.get(conversation_id, ())
+        if self.queued >= self.capacity or len(messages) >= self.queue_size:
+            self.rejected += 1
+            raise asyncio.QueueFull
+        self.queued += 1
+        item = (time.monotonic(), payload)
+        if conversation_id in self.pending:
+            # The conversation is already scheduled, the message is answered after the previous ones
+            self.pending[conversation_id].append(item)
+        else:
+            self.pending[conversation_id] = deque([item])
+            self.ready.put_nowait(conversation_id)
+
+    def queue_depth(self):
+        return self.queued
+
+    def metrics(self):
+        return {
+            "workers": self.workers,
+            "queue_depth": self.queue_depth(),
+            "queue_capacity": self.capacity,
+            "rejected": self.rejected,
+            "failed": self.failed,
+            "wait_time": self.wait_time.summary(),
+            "processing_time": self.processing_time.summary(),
+        }
+
+    # Run blocking work in the worker threads, e.g. the chatbot called by an async handler
+    async def run_blocking(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    async def _work(self):
+        while True:
+            conversation_id = await self.ready.get()
+            messages = self.pending[conversation_id]
+            enqueued_at, payload = messages.popleft()
+            self.queued -= 1
+            started_at = time.monotonic()
+            self.wait_time.observe(started_at - enqueued_at)
+            try:
+                if asyncio.iscoroutinefunction(self.handler):
+                    await self.handler(payload)
+                else:
+                    # The handler is blocking, run it in the thread pool to keep the event loop free
+                    await self.run_blocking(self.handler, payload)
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Failed to answer message in conversation {conversation_id}: {e}")
+            finally:
+                self.processing_time.observe(time.monotonic() - started_at)
+                # Messages that arrived in the meantime wait behind the other ready conversations
+                if messages:
+                    self.ready.put_nowait(conversation_id)
+                else:
+                    del self.pending[conversation_id]
+                self.ready.task_done()
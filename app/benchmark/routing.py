@@ -0,0 +1,98 @@
+"""
+Offline evaluation of the local intent router against the labeled cases in routing_eval.jsonl.
+It reports how many messages the local router decides without the LLM, how accurate these decisions are
+and, with --llm, the accuracy and latency of the LLM router for comparison.
+
+Run from the project root:
+% python -m app.benchmark.routing [--llm] [--min-confidence 0.03]
+"""
+
+import argparse
+import json
+import os
+import time
+
+from app.chatbot import Chatbot
+from app.chatbot.router import IntentRouter, ROUTE_EXAMPLES
+from app.config import settings
+
+EVAL_SET_PATH = os.path.join(os.path.dirname(__file__), "routing_eval.jsonl")
+
+
+def load_cases(path=EVAL_SET_PATH):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+# Set up a chatbot in the state described by the case, with the query as its last message
+def prepare_bot(case):
+    bot = Chatbot()
+    bot.restore([tuple(message) for message in case["history"]])
+    if not case.get("lead_enabled", True):
+        bot.functions = [bot.functions[0]]
+    bot.last_function = case.get("previous_function")
+    bot.add_message("user", case["query"])
+    return bot
+
+
+# Cases that are also classifier examples would overstate the accuracy of the similarity router
+def leaked_cases(cases, examples=ROUTE_EXAMPLES):
+    texts = {text.lower() for function_examples in examples.values() for text in function_examples}
+    return [case["query"] for case in cases if case["query"].lower() in texts]
+
+
+def evaluate(cases, min_confidence, use_llm=False):
+    leaked = leaked_cases(cases)
+    if leaked:
+        print(f"Warning: {len(leaked)} queries are also router examples: {leaked}")
+    local_router = IntentRouter(min_confidence=min_confidence)
+    local_correct, local_decided, llm_correct, combined_correct = 0, 0, 0, 0
+    local_time, llm_time = 0.0, 0.0
+    for case in cases:
+        bot = prepare_bot(case)
+        available = [function["name"] for function in bot.functions]
+
+        start = time.perf_counter()
+        decision = local_router.classify(case["query"], bot.get_chat_history(), available, bot.last_function)
+        local_time += time.perf_counter() - start
+        if decision is not None:
+            local_decided += 1
+            local_correct += decision.function == case["expected"]
+            if decision.function != case["expected"]:
+                print(f"Misrouted locally ({decision.source}, {decision.confidence:.3f}): "
+                      f"{case['query']!r} -> {decision.function}")
+
+        if use_llm:
+            start = time.perf_counter()
+            # The LLM falls back to the retrieval chatbot if it does not request a function
+            llm_function = bot.llm_route(case["query"])[0] or "website_chat"
+            llm_time += time.perf_counter() - start
+            llm_correct += llm_function == case["expected"]
+            routed = decision.function if decision is not None else llm_function
+            combined_correct += routed == case["expected"]
+
+    results = {
+        "cases": len(cases),
+        "local_coverage": local_decided / len(cases),
+        "local_accuracy": local_correct / local_decided if local_decided else None,
+        "local_mean_ms": local_time / len(cases) * 1000,
+    }
+    if use_llm:
+        results.update({
+            "llm_accuracy": llm_correct / len(cases),
+            "llm_mean_ms": llm_time / len(cases) * 1000,
+            "combined_accuracy": combined_correct / len(cases),
+            # Routing time saved per message by deciding locally instead of calling the LLM
+            "saved_mean_ms": (llm_time * local_decided / len(cases) - local_time) / len(cases) * 1000,
+        })
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluate the local intent router")
+    parser.add_argument("--llm", action="store_true", help="Also route every case with the LLM for comparison")
+    parser.add_argument("--min-confidence", type=float, default=settings.ROUTER_MIN_CONFIDENCE)
+    parser.add_argument("--eval-set", default=EVAL_SET_PATH)
+    args = parser.parse_args()
+
+    print(json.dumps(evaluate(load_cases(args.eval_set), args.min_confidence, args.llm), indent=2))
@@ -1 +1,2 @@
 from app.chatbot.chatbot import Chatbot
+from app.chatbot.session import SessionManager
@@ -0,0 +1,159 @@
+import os
+import threading
+import time
+import uuid
+from functools import lru_cache
+
+import numpy as np
+
+from app.config import settings
+from app.core.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+# S3 client for the version of a Pinecone index, created on first use
+@lru_cache(maxsize=None)
+def s3_client():
+    import boto3
+    import botocore.config
+    return boto3.session.Session().client(
+        's3',
+        endpoint_url=settings.AWS_ENDPOINT_URL,
+        config=botocore.config.Config(s3={'addressing_style': 'virtual'}),
+        region_name=settings.AWS_REGION_NAME,
+        aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
+        aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
+    )
+
+
+# Read the version of the vector index written by the indexing script, None if it was never written
+def read_index_version(backend=settings.VECTOR_STORE_BACKEND, path=settings.INDEX_VERSION_PATH):
+    if backend == "pinecone":
+        client = s3_client()
+        try:
+            response = client.get_object(Bucket=settings.S3_BUCKET, Key=settings.INDEX_VERSION_KEY)
+        except client.exceptions.NoSuchKey:
+            return None
+        return response['Body'].read().decode().strip()
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+# Record that the vector index was rebuilt so that cached answers are invalidated
+def mark_index_rebuilt(backend=settings.VECTOR_STORE_BACKEND, path=settings.INDEX_VERSION_PATH):
+    version = uuid.uuid4().hex
+    if backend == "pinecone":
+        s3_client().put_object(Bucket=settings.S3_BUCKET, Key=settings.INDEX_VERSION_KEY, Body=version.encode())
+    else:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as f:
+            f.write(version)
+    logger.info(f"Index version set to {version}")
+    return version
+
+
+# Semantic cache of retrieval answers. An entry is reused when a new standalone query is similar enough
+# to a cached one and the vector store returned the same set of chunks for it.
+class AnswerCache:
+
+    def __init__(self,
+                 threshold=settings.ANSWER_CACHE_THRESHOLD,
+                 max_entries=settings.ANSWER_CACHE_MAX_ENTRIES,
+                 ttl=settings.ANSWER_CACHE_TTL_SECONDS,
+                 backend=settings.VECTOR_STORE_BACKEND,
+                 version_path=settings.INDEX_VERSION_PATH,
+                 version_check_interval=settings.INDEX_VERSION_CHECK_INTERVAL):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.backend = backend
+        self.version_path = version_path
+        self.version_check_interval = version_check_interval
+        self._lock = threading.Lock()
+        self._vectors = None
+        self._entries = [None] * max_entries
+        self._next_slot = 0
+        self._index_version = None
+        self._version_checked = None
+        self._check_index_version()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, query_embedding, source_ids):
+        query = self._normalize(query_embedding)
+        sources = frozenset(source_ids)
+        now = time.time()
+        self._check_index_version()
+        with self._lock:
+            if self._vectors is None:
+                self.misses += 1
+                return None
+            # Scan candidates from most to least similar until one with the same context is found
+            scores = self._vectors @ query
+            candidates = np.flatnonzero(scores >= self.threshold)
+            for slot in candidates[np.argsort(-scores[candidates])]:
+                entry = self._entries[slot]
+                if entry is None or now - entry["created_at"] > self.ttl:
+                    continue
+                if entry["sources"] == sources:
+                    self.hits += 1
+                    logger.info(f"Answer cache hit (similarity {scores[slot]:.3f})")
+                    return entry["answer"]
+            self.misses += 1
+            return None
+
+    def put(self, query_embedding, source_ids, answer):
+        vector = self._normalize(query_embedding)
+        with self._lock:
+            if self._vectors is None:
+                self._vectors = np.zeros((self.max_entries, vector.shape[0]), dtype=np.float32)
+            # Overwrite the oldest entry once the cache is full
+            slot = self._next_slot
+            self._vectors[slot] = vector
+            self._entries[slot] = {"sources": frozenset(source_ids), "answer": answer, "created_at": time.time()}
+            self._next_slot = (slot + 1) % self.max_entries
+
+    def invalidate(self):
+        with self._lock:
+            self._clear()
+
+    def stats(self):
+        return {
+            "entries": sum(entry is not None for entry in self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    @staticmethod
+    def _normalize(embedding):
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    # The version is read at most every version_check_interval seconds and outside of the lock,
+    # reading it from S3 must not block the lookups of other requests
+    def _check_index_version(self):
+        now = time.monotonic()
+        if self._version_checked is not None and now - self._version_checked < self.version_check_interval:
+            return
+        self._version_checked = now
+        try:
+            version = read_index_version(self.backend, self.version_path)
+        except Exception as e:
+            logger.error(f"Unable to read the index version: {e!r}")
+            return
+        with self._lock:
+            if version != self._index_version:
+                if self._index_version is not None or self._vectors is not None:
+                    logger.info("Vector index was rebuilt, clearing answer cache")
+                self._index_version = version
+                self._clear()
+
+    def _clear(self):
+        self._vectors = None
+        self._entries = [None] * self.max_entries
+        self._next_slot = 0
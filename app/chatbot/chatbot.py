@@ -1,29 +1,35 @@
 import json
-import openai
-import requests
-from tenacity import retry, wait_random_exponential, stop_after_attempt
+import time
 from app.chatbot.prompts import DefaultPrompts
+from app.chatbot.router import router
 from app.chatbot.retrieval_chatbot import RetrievalChatbot
 from app.chatbot.lead_chatbot import LeadChatbot
+from app.chatbot.memory import ConversationMemory, summary_pool
 from app.config import settings
-from app.core import logger
+from app.core import logger, openai_client
+from app.core.metrics import StageTimer
 
 logger = logger.get_logger(__name__)
 
-openai.api_key = settings.OPENAI_API_KEY
+
+def log_summary_error(future):
+    if future.exception() is not None:
+        logger.error(f"Unable to extract lead data: {future.exception()}")
+
 
 # Define Chatbot class (Decision-Making Module)
 class Chatbot:
 
     # Initialize chatbot with prompts and sub-chatbots
     def __init__(self):
-        self.conversation_history = []
+        self.memory = ConversationMemory()
         self._lead_generation_status = "In Progress"
         self.lead_data = ""
         self.lead_chatbot = LeadChatbot()
         self.retrieval_chatbot = RetrievalChatbot()
         self.system_prompt = DefaultPrompts.system_prompt()
         self.functions = DefaultPrompts.system_functions()
+        self.last_function = None
         self.add_message("assistant", "Hallo, ich bin der TCW Bot. Wie kann ich Ihnen weiterhelfen?")
 
     # Define getter and setter for lead_generation_status
@@ -37,46 +43,32 @@ class Chatbot:
             return
         self._lead_generation_status = new_status
         if new_status == "Success":
-            self.summarize_conversation()
+            # The lead data is only used by later answers, extract it off the response path
+            summary_pool.submit(self.summarize_conversation).add_done_callback(log_summary_error)
         logger.info("lead_qualification() function disabled")
         self.functions = [self.functions[0]]
 
     # Define ChatCompletion API call
-    @retry(wait=wait_random_exponential(min=1, max=40), stop=stop_after_attempt(3))
     def chat_completion_request(self, messages, functions=None, model="gpt-4-0613"):
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": "Bearer " + openai.api_key,
-        }
-        json_data = {"model": model, "messages": messages}
+        kwargs = {"model": model, "messages": messages}
         if functions is not None:
-            json_data.update({"functions": functions})
+            kwargs.update({"functions": functions})
         try:
-            return requests.post(
-                "https://api.openai.com/v1/chat/completions",
-                headers=headers,
-                json=json_data,
-            )
+            return openai_client.chat_completion(**kwargs)
         except Exception as e:
             logger.error(f"Unable to generate ChatCompletion response: {e}")
             return None
 
     # Define function call when model requests a function
-    def call_chatbot_function(self, messages, full_message):
-        # Identify function name and arguments
-        function_name = full_message["message"]["function_call"]["name"]
-        try:
-            parsed_output = json.loads(full_message["message"]["function_call"]["arguments"])
-        except Exception as e:
-            logger.error(f"Error parsing arguments: {e}")
-            return None
+    def call_chatbot_function(self, function_name, function_query, standalone_query=None):
         # Call lead chatbot or retrieval chatbot based on function name
         if function_name == "website_chat":
             logger.info("Calling website_chat() function")
-            results = self.retrieval_chatbot.chat(parsed_output["query"], self.get_chat_history(), self.get_lead_data())
+            results = self.retrieval_chatbot.chat(function_query, self.get_chat_history(), self.get_lead_data(),
+                                                  standalone_query=standalone_query)
         elif function_name == "lead_qualification":
             logger.info("Calling lead_qualification() function")
-            results, lead_generation_status = self.lead_chatbot.chat(parsed_output["query"], self.get_chat_history())
+            results, lead_generation_status = self.lead_chatbot.chat(function_query, self.get_chat_history())
             self.lead_generation_status = lead_generation_status
         else:
             raise Exception("Function does not exist and cannot be called")
@@ -84,23 +76,90 @@ class Chatbot:
         self.add_message("assistant", str(results))
         return str(results)
 
-    # Function to call ChatCompletion API and execute function if required
-    def chat_completion_with_function_execution(self, query):
+    # Choose the sub-chatbot for the query, locally if possible and with the LLM otherwise.
+    # Returns the function name (None for the retrieval fallback), its query and the standalone query.
+    def route(self, query):
+        start = time.perf_counter()
+        decision = None
+        if settings.ROUTER_LOCAL:
+            available = [function["name"] for function in self.functions]
+            decision = router.classify(query, self.get_chat_history(), available, self.last_function)
+        if decision is not None:
+            function_name, function_query, standalone_query = decision.function, query, None
+            source = f"{decision.source}, confidence {decision.confidence:.3f}"
+        else:
+            function_name, function_query, standalone_query = self.llm_route(query)
+            source = "llm"
+        self.last_function = function_name
+        elapsed = (time.perf_counter() - start) * 1000
+        logger.info(f"Routed to {function_name} ({source}, {elapsed:.0f} ms)")
+        return function_name, function_query, standalone_query
+
+    # Ask the model which sub-chatbot should answer the query
+    def llm_route(self, query):
         messages_body = [{"role": "system", "content": self.system_prompt},
                          {"role": "user", "content": query}]
+        if settings.CONSOLIDATION_USE_ROUTER_QUERY:
+            # Let the routing call rewrite the query as a standalone question for the retrieval chatbot.
+            # The last entry of the history is the current query.
+            recent_history = self.get_chat_history()[-3:-1]
+            messages_body.insert(1, {"role": "system", "content": f"CONVERSATION HISTORY: '{recent_history}'"})
         functions = self.functions
         response = self.chat_completion_request(messages_body, functions)
-        full_message = response.json()["choices"][0]
+        full_message = response["choices"][0]
         if full_message["finish_reason"] == "function_call":
             logger.info(f"Function generation requested")
-            return self.call_chatbot_function(messages_body, full_message)
+            # Identify function name and arguments
+            function_name = full_message["message"]["function_call"]["name"]
+            try:
+                parsed_output = json.loads(full_message["message"]["function_call"]["arguments"])
+            except Exception as e:
+                logger.error(f"Error parsing arguments: {e}")
+                return None, query, None
+            return function_name, parsed_output["query"], parsed_output["query"]
+        logger.info(f"Function not required, calling retrieval chatbot as fallback option")
+        return None, query, None
+
+    # Start the retrieval for the raw query while the turn is routed, unless the rules send it to the lead chatbot
+    def speculate(self, query, timer):
+        if not settings.SPECULATIVE_RETRIEVAL:
+            return
+        if settings.ROUTER_LOCAL:
+            available = [function["name"] for function in self.functions]
+            decision = router.rule_route(query, self.get_chat_history(), available, self.last_function)
+            if decision is not None and decision.function != "website_chat":
+                return
+        self.retrieval_chatbot.speculate(query, timer)
+
+    # Function to call ChatCompletion API and execute function if required
+    def chat_completion_with_function_execution(self, query, timer=None):
+        timer = timer or StageTimer()
+        with timer.stage("route"):
+            function_name, function_query, standalone_query = self.route(query)
+        with timer.stage("answer"):
+            if function_name is not None:
+                return self.call_chatbot_function(function_name, function_query, standalone_query)
+            else:
+                return self.retrieval_chatbot.chat(query, self.get_chat_history())
+
+    # Streaming counterpart of call_chatbot_function, yields the answer token by token
+    def stream_chatbot_function(self, query, function_name, function_query, standalone_query=None):
+        if function_name is None:
+            return (yield from self.retrieval_chatbot.chat_stream(query, self.get_chat_history()))
+        elif function_name == "website_chat":
+            logger.info("Calling website_chat() function")
+            yield from self.retrieval_chatbot.chat_stream(function_query, self.get_chat_history(),
+                                                          self.get_lead_data(), standalone_query=standalone_query)
+            return None
+        elif function_name == "lead_qualification":
+            logger.info("Calling lead_qualification() function")
+            return (yield from self.lead_chatbot.chat_stream(function_query, self.get_chat_history()))
         else:
-            logger.info(f"Function not required, calling retrieval chatbot as fallback option")
-            return self.retrieval_chatbot.chat(query, self.get_chat_history())
+            raise Exception("Function does not exist and cannot be called")
 
     # Function to summarize conversation history of LGM to extract lead data
     def summarize_conversation(self):
-        completion = openai.ChatCompletion.create(
+        completion = openai_client.chat_completion(
             model="gpt-3.5-turbo-16k",
             messages=[
                 {"role": "system", "content": f"CONVERSATION HISTORY: '{self.get_chat_history()}'"},
@@ -114,23 +173,61 @@ class Chatbot:
         self.lead_data = result
         logger.info(f"Lead data extracted: {self.lead_data}")
 
+    # Restore the state of a previous conversation without calling the OpenAI API
+    def restore(self, messages, lead_generation_status="In Progress", lead_data=""):
+        for role, content in messages:
+            self.add_message(role, content)
+        if lead_generation_status != "In Progress":
+            self._lead_generation_status = lead_generation_status
+            self.functions = [self.functions[0]]
+        self.lead_data = lead_data
+
     # Supporting functions to add and get chat history and lead data
     def add_message(self, role, content):
         message = f"{role}: {content}"
-        self.conversation_history.append(message)
+        self.memory.add(message)
 
     def get_chat_history(self):
-        return self.conversation_history
+        return self.memory.get_history()
 
     def get_lead_data(self):
         return self.lead_data
 
     # Initial function called by API module
     def chat(self, query):
-        self.add_message("user", query)
-        chat_response = self.chat_completion_with_function_execution(query)
+        timer = StageTimer()
+        with timer.stage("total"):
+            self.add_message("user", query)
+            self.speculate(query, timer)
+            chat_response = self.chat_completion_with_function_execution(query, timer)
+        logger.info(f"Turn timings: {timer}")
         return chat_response
 
+    # Streaming variant of chat() used by the SSE endpoint, yields the answer token by token
+    def chat_stream(self, query):
+        timer = StageTimer()
+        start = time.perf_counter()
+        self.add_message("user", query)
+        self.speculate(query, timer)
+        with timer.stage("route"):
+            stream = self.stream_chatbot_function(query, *self.route(query))
+        tokens = []
+        while True:
+            try:
+                token = next(stream)
+            except StopIteration as stop:
+                lead_generation_status = stop.value
+                break
+            if not tokens:
+                timer.record("first_token", time.perf_counter() - start)
+            tokens.append(token)
+            yield token
+        self.add_message("assistant", "".join(tokens))
+        if lead_generation_status is not None:
+            self.lead_generation_status = lead_generation_status
+        timer.record("total", time.perf_counter() - start)
+        logger.info(f"Turn timings: {timer}")
+
 # Main function to test chatbot locally in terminal
 def main():
     bot = Chatbot()
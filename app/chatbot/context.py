@@ -0,0 +1,90 @@
+import re
+from functools import lru_cache
+
+import tiktoken
+
+from app.config import settings
+from app.core.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+# Loaded on first use, tiktoken downloads the encoding file unless it is in its cache directory
+@lru_cache(maxsize=None)
+def get_encoding():
+    return tiktoken.encoding_for_model(settings.GPT_MODEL)
+
+
+def count_tokens(text):
+    return len(get_encoding().encode(str(text)))
+
+
+def truncate_tokens(text, max_tokens):
+    encoding = get_encoding()
+    return encoding.decode(encoding.encode(text)[:max_tokens])
+
+
+# Assemble retrieved chunks and chat history for the answer prompt within a token budget
+class ContextBuilder:
+
+    def __init__(self,
+                 max_context_tokens=settings.CONTEXT_MAX_TOKENS,
+                 max_history_tokens=settings.HISTORY_MAX_TOKENS,
+                 min_chunk_tokens=50,
+                 max_summary_tokens=None):
+        self.max_context_tokens = max_context_tokens
+        self.max_history_tokens = max_history_tokens
+        self.min_chunk_tokens = min_chunk_tokens
+        # The summary of older messages may take at most half of the history budget by default
+        self.max_summary_tokens = max_history_tokens // 2 if max_summary_tokens is None else max_summary_tokens
+
+    # Select the best scoring chunks that fit the budget and format them grouped by source
+    def build_context(self, matches):
+        grouped_items = {}
+        seen = set()
+        budget = self.max_context_tokens
+        for item in sorted(matches, key=lambda match: match.get('score') or 0, reverse=True):
+            text = item['metadata']['text']
+            # The same text may be stored for several pages, e.g. shared page sections
+            key = re.sub(r"\s+", " ", text).strip().lower()
+            if key in seen:
+                continue
+            seen.add(key)
+
+            tokens = count_tokens(text)
+            if tokens > budget:
+                # Only cut a chunk if enough of it is left to be useful
+                if budget < self.min_chunk_tokens:
+                    continue
+                text, tokens = truncate_tokens(text, budget), budget
+            budget -= tokens
+            grouped_items.setdefault(item['metadata']['source-url'], []).append(text)
+
+        formatted_list = []
+        for source_url, texts in grouped_items.items():
+            concatenated_texts = "".join(f"- {text}\n" for text in texts)
+            formatted_list.append(f"SOURCE: {source_url}\nCONTENT:\n{concatenated_texts}")
+        return "\n".join(formatted_list)
+
+    # Keep the summary of older messages, truncated if needed, and the most recent messages that fit the budget
+    def fit_history(self, history):
+        budget = self.max_history_tokens
+        summary = None
+        if history and history[0].startswith("summary: "):
+            summary, history = history[0], history[1:]
+            if count_tokens(summary) > self.max_summary_tokens:
+                summary = truncate_tokens(summary, self.max_summary_tokens)
+            budget -= count_tokens(summary)
+        kept = []
+        for message in reversed(history):
+            tokens = count_tokens(message)
+            if tokens > budget:
+                break
+            budget -= tokens
+            kept.append(message)
+        kept.reverse()
+        if len(kept) < len(history):
+            kept.insert(0, f"({len(history) - len(kept)} earlier messages omitted)")
+        if summary is not None:
+            kept.insert(0, summary)
+        return kept
@@ -0,0 +1,147 @@
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import numpy as np
+
+from app.config import settings
+from app.core.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+# Normalize a query so that trivial variations share one cache entry
+def normalize_text(text):
+    text = unicodedata.normalize("NFKC", text).casefold()
+    text = re.sub(r"\s+", " ", text)
+    return text.strip(" ?!.")
+
+
+# Two-tier cache for query embeddings: an in-process LRU backed by a SQLite file
+class EmbeddingCache:
+
+    def __init__(self,
+                 path=settings.EMBEDDING_CACHE_PATH,
+                 max_memory_entries=settings.EMBEDDING_CACHE_MEMORY_ENTRIES,
+                 max_disk_entries=settings.EMBEDDING_CACHE_DISK_ENTRIES):
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self._memory = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._db = None
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS embeddings "
+                             "(key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_access REAL NOT NULL)")
+            self._db.commit()
+
+    @staticmethod
+    def make_key(model, text):
+        return hashlib.sha256(f"{model}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+    # Return the cached embedding as a list of floats or None
+    def get(self, model, text):
+        key = self.make_key(model, text)
+        with self._lock:
+            vector = self._memory.get(key)
+            if vector is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return vector.tolist()
+
+            if self._db is not None:
+                row = self._db.execute("SELECT vector FROM embeddings WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    self._db.execute("UPDATE embeddings SET last_access = ? WHERE key = ?", (time.time(), key))
+                    self._db.commit()
+                    vector = np.frombuffer(row[0], dtype=np.float32)
+                    self._remember(key, vector)
+                    self.disk_hits += 1
+                    return vector.tolist()
+
+            self.misses += 1
+            return None
+
+    def put(self, model, text, embedding):
+        key = self.make_key(model, text)
+        vector = np.asarray(embedding, dtype=np.float32)
+        with self._lock:
+            self._remember(key, vector)
+            if self._db is None:
+                return
+            self._db.execute("INSERT OR REPLACE INTO embeddings (key, vector, last_access) VALUES (?, ?, ?)",
+                             (key, vector.tobytes(), time.time()))
+            self._db.commit()
+            self._writes += 1
+            if self._writes % 100 == 0:
+                self._prune_disk()
+
+    # Return the cached embedding or compute and store it with embed_fn.
+    # Concurrent requests for the same text, e.g. routing and speculative retrieval, share one call.
+    def get_or_create(self, model, text, embed_fn):
+        embedding = self.get(model, text)
+        if embedding is not None:
+            return embedding
+
+        key = self.make_key(model, text)
+        with self._lock:
+            vector = self._memory.get(key)
+            if vector is not None:
+                return vector.tolist()
+            future = self._pending.get(key)
+            owner = future is None
+            if owner:
+                future = self._pending[key] = Future()
+        if not owner:
+            return future.result()
+
+        try:
+            embedding = embed_fn(text)
+            self.put(model, text, embedding)
+            future.set_result(embedding)
+            return embedding
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._pending[key]
+
+    def stats(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_entries": len(self._memory),
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round((lookups - self.misses) / lookups, 3) if lookups else None,
+        }
+
+    def _remember(self, key, vector):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    # Delete the least recently used entries exceeding the disk limit
+    def _prune_disk(self):
+        count = self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        excess = count - self.max_disk_entries
+        if excess > 0:
+            self._db.execute("DELETE FROM embeddings WHERE key IN "
+                             "(SELECT key FROM embeddings ORDER BY last_access LIMIT ?)", (excess,))
+            self._db.commit()
+            logger.info(f"Pruned {excess} entries from the embedding cache")
@@ -1,20 +1,23 @@
-import openai
-from app.config import settings
 from app.chatbot.prompts import LeadPrompts
+from app.core import openai_client
 from app.core.logger import get_logger
 
 logger = get_logger(__name__)
 
+# Fixed replies sent when the lead generation process ends
+ABORTED_ANSWER = "Was möchten Sie über das TCW wissen?"
+SUCCESS_ANSWER = "Vielen Dank für Ihre Informationen. Was möchten Sie über das TCW erfahren?"
+
 # Define Chatbot class (Lead Generation Module)
 class LeadChatbot:
     def __init__(self, history=None):
         self.chat_history = history or []
-        openai.api_key = settings.OPENAI_API_KEY
+
     # Define ChatCompletion API call
     def get_answer(self, user_message):
         system_prompt = LeadPrompts.system_prompt(self.chat_history)
         try:
-            response = openai.ChatCompletion.create(
+            response = openai_client.chat_completion(
                 # TODO: add config variable for model
                 model="gpt-4",
                 messages=[
@@ -33,21 +36,57 @@ class LeadChatbot:
         # Logic to handle completion / abortion of lead generation process
         if answer == "-1":
             logger.info("Lead generation process aborted.")
-            answer = "Was möchten Sie über das TCW wissen?"
+            answer = ABORTED_ANSWER
             return answer, "Aborted"
         elif answer == "200":
             logger.info("Lead generation process completed successfully.")
-            answer = "Vielen Dank für Ihre Informationen. Was möchten Sie über das TCW erfahren?"
+            answer = SUCCESS_ANSWER
             return answer, "Success"
         else:
             return answer, "In Progress"
 
+    # Stream the answer token by token and return the lead generation status.
+    # Tokens are held back while the answer could still be one of the status codes.
+    def get_answer_stream(self, user_message):
+        system_prompt = LeadPrompts.system_prompt(self.chat_history)
+        answer = ""
+        buffered = True
+        for token in openai_client.chat_completion_stream(
+                model="gpt-4",
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": user_message},
+                ]
+        ):
+            answer += token
+            if buffered and ("-1".startswith(answer.strip()) or "200".startswith(answer.strip())):
+                continue
+            yield answer if buffered else token
+            buffered = False
+
+        if buffered:
+            if answer.strip() == "-1":
+                logger.info("Lead generation process aborted.")
+                yield ABORTED_ANSWER
+                return "Aborted"
+            elif answer.strip() == "200":
+                logger.info("Lead generation process completed successfully.")
+                yield SUCCESS_ANSWER
+                return "Success"
+            yield answer
+        return "In Progress"
+
     def chat(self, query, history=None):
         if history:
             self.chat_history = history
         final_answer, lead_generation_status = self.get_answer(query)
         return final_answer, lead_generation_status
 
+    def chat_stream(self, query, history=None):
+        if history:
+            self.chat_history = history
+        return (yield from self.get_answer_stream(query))
+
 # Define main function to test chatbot
 if __name__ == "__main__":
     bot = LeadChatbot()
@@ -0,0 +1,66 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from app.chatbot.prompts import MemoryPrompts
+from app.config import settings
+from app.core import openai_client
+from app.core.logger import get_logger
+
+logger = get_logger(__name__)
+
+# Summaries are written off the hot path, shared by all conversations of the process
+summary_pool = ThreadPoolExecutor(max_workers=settings.MEMORY_SUMMARY_WORKERS, thread_name_prefix="memory-summary")
+
+
+# Conversation memory keeping the most recent messages verbatim and older ones as a rolling summary.
+# Messages stay verbatim until their summary is ready, so reading the history never waits for the LLM.
+class ConversationMemory:
+
+    def __init__(self,
+                 max_messages=settings.MEMORY_MAX_MESSAGES,
+                 summary_batch=settings.MEMORY_SUMMARY_BATCH,
+                 executor=summary_pool):
+        self.max_messages = max_messages
+        self.summary_batch = summary_batch
+        self.executor = executor
+        self.messages = []
+        self.summary = ""
+        self._future = None
+        self._lock = threading.Lock()
+
+    def add(self, message):
+        with self._lock:
+            self.messages.append(message)
+            overflow = len(self.messages) - self.max_messages
+            # Summarize in batches to keep the number of LLM calls low
+            if overflow >= self.summary_batch and self._future is None:
+                old_messages = self.messages[:overflow]
+                self._future = self.executor.submit(self._summarize, old_messages, self.summary)
+
+    # History used in prompts: the summary of older messages followed by the recent messages
+    def get_history(self):
+        with self._lock:
+            if self.summary:
+                return [f"summary: {self.summary}"] + list(self.messages)
+            return list(self.messages)
+
+    def _summarize(self, old_messages, summary):
+        try:
+            response = openai_client.chat_completion(
+                model=settings.MEMORY_SUMMARY_MODEL,
+                messages=[{"role": "system", "content": MemoryPrompts.summary_prompt(summary, old_messages)}],
+                temperature=0,
+            )
+            new_summary = response['choices'][0]['message']['content']
+        except Exception as e:
+            logger.error(f"Unable to summarize conversation history: {e}")
+            with self._lock:
+                self._future = None
+            return
+
+        with self._lock:
+            # Messages are only appended, the summarized ones are still at the start of the list
+            del self.messages[:len(old_messages)]
+            self.summary = new_summary
+            self._future = None
+        logger.info(f"Summarized {len(old_messages)} messages into conversation memory")
@@ -114,6 +114,27 @@ class LeadPrompts:
         return prompt
 
 
+class MemoryPrompts:
+    @staticmethod
+    def summary_prompt(summary, messages):
+        prompt = f'''Your ONLY task is to update the SUMMARY of a conversation between a user and the TCW chatbot with the NEW MESSAGES.
+                    - Keep ALL information the user stated about themselves, e.g. name, company, industry, position, email, phone, interests, pain points and budget.
+                    - Keep the topics the user asked about and the key facts of the answers, including source URLs.
+                    - DO NOT add information that is not in the SUMMARY or the NEW MESSAGES.
+                    - Write in the language of the conversation. The default language is German.
+                    - Answer with the updated summary only, in maximum 150 words.
+
+                    SUMMARY: """
+                    {summary}
+                    """
+                    ###
+                    NEW MESSAGES: """
+                    {messages}
+                    """
+                '''
+        return prompt
+
+
 class DefaultPrompts:
     @staticmethod
     def system_prompt():
@@ -138,7 +159,7 @@ class DefaultPrompts:
                     "properties": {
                         "query": {
                             "type": "string",
-                            "description": "User query to the assistant asking about TCW website",
+                            "description": "User query to the assistant asking about TCW website, rewritten as a standalone question including all relevant information from the CONVERSATION HISTORY",
                         }
                     },
                     "required": ["query"],
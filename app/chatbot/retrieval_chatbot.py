@@ -1,100 +1,158 @@
 # https://github.com/openai/openai-cookbook/blob/main/examples/How_to_format_inputs_to_ChatGPT_models.ipynb
-import openai
-import pinecone
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from app.config import settings
+from app.chatbot.answer_cache import AnswerCache
+from app.chatbot.context import ContextBuilder, count_tokens
+from app.chatbot.embedding_cache import EmbeddingCache, normalize_text
 from app.chatbot.prompts import RetrievalPrompts
-from app.core import logger
+from app.core import logger, openai_client
+from app.vectorstore import KeywordIndex, get_vector_store, reciprocal_rank_fusion
 
 logger = logger.get_logger(__name__)
 
-openai.api_key = settings.OPENAI_API_KEY
+# Pronouns and adverbs that refer back to earlier turns. Capitalized forms are the formal "Sie"/"Ihr" and
+# therefore only count at the start of a question.
+REFERENCE_WORDS = {
+    "er", "sie", "ihn", "ihm", "ihr", "ihre", "ihrem", "ihren", "ihrer", "sein", "seine", "seinem", "seinen",
+    "seiner", "dessen", "deren", "dort", "dabei", "damit", "dazu", "davon", "darüber", "darauf", "daran",
+    "dafür", "dies", "diese", "dieser", "dieses", "diesem", "diesen", "jene", "jener", "jenes",
+    "he", "she", "him", "his", "her", "they", "them", "their", "this", "that", "these", "those", "there",
+}
+FOLLOW_UP_PATTERN = re.compile(r"^(und|aber|auch|noch|also|and|but|what about|how about)\b", re.IGNORECASE)
+MIN_SELF_CONTAINED_WORDS = 4
+
+# Vector store and caches are shared by all conversations of the process
+vector_store = get_vector_store()
+embedding_cache = EmbeddingCache()
+answer_cache = AnswerCache() if settings.ANSWER_CACHE_ENABLED else None
+keyword_index = KeywordIndex() if settings.HYBRID_SEARCH else None
+search_pool = ThreadPoolExecutor(max_workers=settings.OPENAI_MAX_CONCURRENCY, thread_name_prefix="vector-search")
+# Speculative searches submit their dense search to search_pool, they must not share its workers
+speculation_pool = ThreadPoolExecutor(max_workers=settings.OPENAI_MAX_CONCURRENCY, thread_name_prefix="speculation")
+
+
+# Check if a question can be understood without the conversation history
+def is_self_contained(query):
+    words = re.findall(r"\w+", query)
+    if len(words) < MIN_SELF_CONTAINED_WORDS or FOLLOW_UP_PATTERN.match(query.strip()):
+        return False
+    return not any(word.lower() in REFERENCE_WORDS if i == 0 else word in REFERENCE_WORDS
+                   for i, word in enumerate(words))
 
-# Initialize connection to Pinecone
-pinecone.init(
-    api_key=settings.PINECONE_API_KEY,
-    environment=settings.PINECONE_ENVIRONMENT
-)
 
 # Define Chatbot class (Knowledge Retrieval Module)
 class RetrievalChatbot:
-    def __init__(self, history=[]):
-        self.chat_history = history
-        self.embed_model = "text-embedding-ada-002"
-        self.index = pinecone.Index(settings.PINECONE_INDEX_NAME)
+    def __init__(self, history=None):
+        self.chat_history = history or []
+        self.embed_model = settings.EMBEDDING_MODEL
+        self.index = vector_store
+        self.context_builder = ContextBuilder()
+        self._speculative = None
 
     # Consolidate query and history into new query for retrieval
-    def consolidate_query(self, query, history):
+    def consolidate_query(self, query, history, standalone_query=None):
+        start = time.perf_counter()
         if len(history) == 0:
-            return query
+            path, answer = "no_history", query
+        elif standalone_query and settings.CONSOLIDATION_USE_ROUTER_QUERY:
+            # The routing call already rewrote the question with the recent history
+            path, answer = "router", standalone_query
+        elif settings.CONSOLIDATION_SKIP_SELF_CONTAINED and is_self_contained(query):
+            path, answer = "self_contained", query
         else:
             # Get last two message pairs to consider for context
             recent_history = history[-2:]
             system_prompt = RetrievalPrompts.summary_prompt(chat_history=recent_history, user_question=query)
-            response = openai.ChatCompletion.create(
-                model="gpt-4",
+            response = openai_client.chat_completion(
+                model=settings.CONSOLIDATION_MODEL,
                 messages=[
                     {"role": "system", "content": system_prompt},
                 ]
             )
-            answer = response['choices'][0]['message']['content']
-            logger.info(f"Contextualized Query: {answer}")
-            return answer
-
-    def query_vector(self, query):
-        # Get embedding for user query
-        res = openai.Embedding.create(
-            input=[query],
-            engine=self.embed_model
-        )
-        embedded_question = res['data'][0]['embedding']
+            path, answer = "llm", response['choices'][0]['message']['content']
+        elapsed = (time.perf_counter() - start) * 1000
+        logger.info(f"Contextualized Query ({path}, {elapsed:.0f} ms): {answer}")
+        return answer
 
-        # Get relevant document chunks from Pinecone
-        query_results = self.index.query(
+    # Get embedding for user query
+    def embed_query(self, query):
+        return embedding_cache.get_or_create(
+            self.embed_model, query, lambda text: openai_client.embed_texts([text], model=self.embed_model)[0])
+
+    # Get relevant document chunks from the vector store
+    def vector_search(self, embedded_question, top_k=5):
+        return self.index.query(
             embedded_question,
-            top_k=5,
+            top_k=top_k,
             include_metadata=True
         )
-        print(query_results)
-        return query_results
 
-    # Extract content from results object
+    def dense_search(self, query, top_k=5):
+        return self.vector_search(self.embed_query(query), top_k)
+
+    # Combine dense and keyword search with reciprocal rank fusion. The keyword index is local, its results
+    # are used alone if the vector store query fails or is too slow. The embedding is not part of the timeout.
+    def query_vector(self, query, top_k=5):
+        if keyword_index is None:
+            return self.dense_search(query, top_k)
+
+        future = search_pool.submit(self.vector_search, self.embed_query(query), top_k)
+        keyword_results = keyword_index.query(query, top_k)
+        if not keyword_results["matches"]:
+            # Nothing to fall back to, e.g. the keyword index is not built yet
+            return future.result()
+        try:
+            vector_results = future.result(timeout=settings.VECTOR_SEARCH_TIMEOUT)
+        except Exception as e:
+            logger.error(f"Vector search unavailable, using keyword results only: {e!r}")
+            return keyword_results
+        return reciprocal_rank_fusion([vector_results, keyword_results], top_k)
+
+    # Start the search for the raw query before it is known whether the retrieval chatbot answers the turn
+    def speculate(self, query, timer=None):
+        def search():
+            start = time.perf_counter()
+            try:
+                return self.query_vector(query)
+            finally:
+                if timer is not None:
+                    timer.record("speculative_retrieval", time.perf_counter() - start)
+
+        self._speculative = (query, speculation_pool.submit(search))
+
+    # Results of the speculative search if it was started for the same query
+    def speculative_results(self, query):
+        speculative, self._speculative = self._speculative, None
+        if speculative is None or normalize_text(speculative[0]) != normalize_text(query):
+            return None
+        try:
+            return speculative[1].result()
+        except Exception as e:
+            logger.error(f"Speculative retrieval failed: {e!r}")
+            return None
+
+    # Extract content from results object, ranked, deduplicated and trimmed to the token budget
     def get_content(self, query_results):
-        grouped_items = {}
-
-        # Loop through the list of dictionaries with metadata and text
-        for item in query_results['matches']:
-            source_url = item['metadata']['source-url']
-            if source_url in grouped_items:
-                grouped_items[source_url].append(item)
-            else:
-                grouped_items[source_url] = [item]
-
-        # Format the content into a list of strings to be easily readable by LLM
-        formatted_list = []
-        for source_url, items in grouped_items.items():
-            concatenated_texts = ""
-
-            for item in items:
-                text = item['metadata']['text']
-                concatenated_texts += f"- {text}\n"
-
-            formatted_entry = f"SOURCE: {source_url}\nCONTENT:\n{concatenated_texts}"
-            formatted_list.append(formatted_entry)
-
-        # Join the list of strings into a single string to be used as input to LLM
-        content = "\n".join(formatted_list)
-        return content
+        return self.context_builder.build_context(query_results['matches'])
+
+    # Build the answer prompt from the retrieved content and the recent chat history
+    def answer_messages(self, query, retrieved_content, lead_data=None, include_history=True):
+        chat_history = self.context_builder.fit_history(self.get_chat_history()) if include_history else []
+        system_prompt = RetrievalPrompts.answer_prompt(chat_history=chat_history, context=retrieved_content, user_data=lead_data)
+        logger.info(f"Answer prompt tokens: {count_tokens(system_prompt) + count_tokens(query)}")
+        return [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": query},
+        ]
 
     # Get answer from KRM (called by DMM)
-    def get_answer(self, query, retrieved_content, lead_data=None):
-        system_prompt = RetrievalPrompts.answer_prompt(chat_history=self.get_chat_history(), context=retrieved_content, user_data=lead_data)
-        response = openai.ChatCompletion.create(
+    def get_answer(self, query, retrieved_content, lead_data=None, include_history=True):
+        response = openai_client.chat_completion(
             model="gpt-4",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": query},
-            ]
+            messages=self.answer_messages(query, retrieved_content, lead_data, include_history)
         )
         answer = response['choices'][0]['message']['content']
         if __name__ == "__main__":
@@ -102,18 +160,68 @@ class RetrievalChatbot:
 
         return answer
 
+    # Stream the answer token by token
+    def get_answer_stream(self, query, retrieved_content, lead_data=None, include_history=True):
+        yield from openai_client.chat_completion_stream(
+            model="gpt-4",
+            messages=self.answer_messages(query, retrieved_content, lead_data, include_history)
+        )
+
     def get_chat_history(self):
         return self.chat_history
 
-    def chat(self, query, history=None, user_data=None):
+    # Retrieve the content for a query. Returns a cached answer instead if one matches, otherwise the content,
+    # the key to cache the new answer under and the standalone query it is answered from.
+    def retrieve(self, query, history=None, user_data=None, standalone_query=None):
         if history:
             self.chat_history = history
-        summarized_query = self.consolidate_query(query, self.chat_history)
-        query_results = self.query_vector(summarized_query)
-        content = self.get_content(query_results)
-        final_answer = self.get_answer(query, content, user_data)
+        summarized_query = self.consolidate_query(query, self.chat_history, standalone_query)
+        start = time.perf_counter()
+        query_results, source = self.speculative_results(summarized_query), "speculative"
+        if query_results is None:
+            query_results, source = self.query_vector(summarized_query), "search"
+        elapsed = (time.perf_counter() - start) * 1000
+        logger.info(f"Retrieved {len(query_results['matches'])} matches ({source}, {elapsed:.0f} ms)")
+
+        # Personalized answers are never shared between conversations. Answers that may be cached are generated
+        # from the standalone query without the chat history, which can contain details given by the user.
+        query_embedding = embedding_cache.get(self.embed_model, summarized_query) if answer_cache else None
+        cache_key = None
+        if query_embedding is not None and not user_data:
+            cache_key = (query_embedding, [match['id'] for match in query_results['matches']])
+            cached_answer = answer_cache.get(*cache_key)
+            if cached_answer is not None:
+                return cached_answer, None, None, summarized_query
+
+        return None, self.get_content(query_results), cache_key, summarized_query
+
+    def chat(self, query, history=None, user_data=None, standalone_query=None):
+        cached_answer, content, cache_key, summarized_query = self.retrieve(query, history, user_data, standalone_query)
+        if cached_answer is not None:
+            return cached_answer
+        if cache_key is None:
+            final_answer = self.get_answer(query, content, user_data)
+        else:
+            final_answer = self.get_answer(summarized_query, content, include_history=False)
+            answer_cache.put(*cache_key, final_answer)
         return final_answer
 
+    def chat_stream(self, query, history=None, user_data=None, standalone_query=None):
+        cached_answer, content, cache_key, summarized_query = self.retrieve(query, history, user_data, standalone_query)
+        if cached_answer is not None:
+            yield cached_answer
+            return
+        if cache_key is None:
+            stream = self.get_answer_stream(query, content, user_data)
+        else:
+            stream = self.get_answer_stream(summarized_query, content, include_history=False)
+        tokens = []
+        for token in stream:
+            tokens.append(token)
+            yield token
+        if cache_key is not None:
+            answer_cache.put(*cache_key, "".join(tokens))
+
 
 # Main function to test chatbot locally in terminal
 if __name__ == "__main__":
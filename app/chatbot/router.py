@@ -0,0 +1,157 @@
+import re
+from collections import namedtuple
+
+import numpy as np
+
+from app.chatbot.retrieval_chatbot import embedding_cache
+from app.config import settings
+from app.core import openai_client
+from app.core.logger import get_logger
+
+logger = get_logger(__name__)
+
+RouteDecision = namedtuple("RouteDecision", ["function", "confidence", "source"])
+
+# Labeled examples of the embedding classifier, one list per function of DefaultPrompts.system_functions()
+ROUTE_EXAMPLES = {
+    "website_chat": [
+        "Was macht das TCW?",
+        "Welche Leistungen bietet TCW an?",
+        "Wer ist Prof. Wildemann?",
+        "Wie kann ich TCW kontaktieren?",
+        "Wo befindet sich das TCW?",
+        "Welche Seminare gibt es?",
+        "Bietet TCW Beratung zum Thema Einkauf an?",
+        "Gibt es Bücher von Prof. Wildemann zu Lean Management?",
+        "Was kostet eine Beratung?",
+        "Welche Referenzen hat das TCW?",
+        "Erzähl mir mehr über die Branchen, in denen TCW tätig ist",
+        "Wann wurde das TCW gegründet?",
+        "Hat das TCW offene Stellen?",
+        "What services does TCW offer?",
+        "Who founded TCW?",
+    ],
+    "lead_qualification": [
+        "Hallo",
+        "Guten Tag",
+        "Mein Name ist Max Mustermann",
+        "Ich heiße Anna Schmidt",
+        "Ich arbeite bei Siemens",
+        "Ich bin Einkaufsleiter",
+        "Wir sind ein mittelständisches Unternehmen aus dem Maschinenbau",
+        "Meine E-Mail ist max@example.com",
+        "Automobilindustrie",
+        "Geschäftsführer",
+        "Das möchte ich nicht sagen",
+        "Ich möchte keine weiteren Fragen beantworten",
+        "Lieber nicht",
+        "My name is John Smith",
+        "I work as a project manager",
+    ],
+}
+
+EMAIL_PATTERN = re.compile(r"[\w.+-]+@[\w-]+\.[\w.-]+")
+PHONE_PATTERN = re.compile(r"(\+|\b0)\d[\d /-]{6,}\d")
+LEAD_PATTERN = re.compile(
+    r"\b(mein name|ich heiße|ich arbeite|ich bin (bei|als|der|die)|meine (e-?mail|nummer|firma)|"
+    r"keine (weiteren )?fragen|nicht sagen|my name|i work|no more questions)\b",
+    re.IGNORECASE,
+)
+QUESTION_PATTERN = re.compile(
+    r"^(wer|was|wann|wo|wie|welche\w*|warum|wieso|weshalb|gibt es|bietet|hat|haben|kann|können|"
+    r"who|what|when|where|how|which|why|does|do|can|is|are)\b",
+    re.IGNORECASE,
+)
+
+
+def is_question(query):
+    query = query.strip()
+    return query.endswith("?") or bool(QUESTION_PATTERN.match(query))
+
+
+# Route a message to a sub-chatbot without calling the LLM. Keyword rules decide the obvious cases,
+# an embedding similarity classifier over ROUTE_EXAMPLES the rest. Returns None when not confident.
+class IntentRouter:
+
+    def __init__(self,
+                 examples=ROUTE_EXAMPLES,
+                 min_confidence=settings.ROUTER_MIN_CONFIDENCE,
+                 neighbors=settings.ROUTER_NEIGHBORS,
+                 model=settings.EMBEDDING_MODEL):
+        self.examples = examples
+        self.min_confidence = min_confidence
+        self.neighbors = neighbors
+        self.model = model
+        self._labels = None
+        self._vectors = None
+
+    # History is the conversation memory, its last entry is the current query
+    def classify(self, query, history, functions, previous_function=None):
+        decision = self.rule_route(query, history, functions, previous_function)
+        if decision is None:
+            try:
+                decision = self.similarity_route(query, functions)
+            except Exception as e:
+                logger.error(f"Unable to classify query locally: {e!r}")
+                return None
+        if decision is None or decision.confidence < self.min_confidence:
+            return None
+        return decision
+
+    @staticmethod
+    def rule_route(query, history, functions, previous_function=None):
+        if len(functions) == 1:
+            return RouteDecision(functions[0], 1.0, "rule")
+        # The lead qualification starts with the first message of a conversation
+        if not any(message.startswith("user: ") for message in history[:-1]):
+            return RouteDecision("lead_qualification", 1.0, "rule")
+        if EMAIL_PATTERN.search(query) or PHONE_PATTERN.search(query) or LEAD_PATTERN.search(query):
+            return RouteDecision("lead_qualification", 1.0, "rule")
+        # Replies to a question of the lead chatbot
+        if previous_function == "lead_qualification" and not is_question(query):
+            return RouteDecision("lead_qualification", 1.0, "rule")
+        # Follow-up questions to an answer of the retrieval chatbot
+        if previous_function == "website_chat" and is_question(query):
+            return RouteDecision("website_chat", 1.0, "rule")
+        return None
+
+    # Compare the mean similarity of the nearest examples of each function, the margin is the confidence
+    def similarity_route(self, query, functions):
+        labels, vectors = self._example_vectors()
+        vector = np.asarray(self._embed(query), dtype=np.float32)
+        similarities = vectors @ (vector / np.linalg.norm(vector))
+        scores = {}
+        for function in functions:
+            function_similarities = similarities[labels == function]
+            if len(function_similarities):
+                scores[function] = float(np.sort(function_similarities)[-self.neighbors:].mean())
+        if len(scores) < 2:
+            return None
+        ranked = sorted(scores, key=scores.get, reverse=True)
+        return RouteDecision(ranked[0], scores[ranked[0]] - scores[ranked[1]], "similarity")
+
+    def _embed(self, text):
+        return embedding_cache.get_or_create(
+            self.model, text, lambda text: openai_client.embed_texts([text], model=self.model)[0])
+
+    # Embed the examples once, in one request for those that are not cached yet
+    def _example_vectors(self):
+        if self._vectors is None:
+            labels = [label for label, texts in self.examples.items() for _ in texts]
+            texts = [text for texts in self.examples.values() for text in texts]
+            embeddings = [embedding_cache.get(self.model, text) for text in texts]
+            missing = [text for text, embedding in zip(texts, embeddings) if embedding is None]
+            if missing:
+                new_embeddings = dict(zip(missing, openai_client.embed_texts(missing, model=self.model)))
+                for text, embedding in new_embeddings.items():
+                    embedding_cache.put(self.model, text, embedding)
+                embeddings = [embedding if embedding is not None else new_embeddings[text]
+                              for text, embedding in zip(texts, embeddings)]
+            vectors = np.asarray(embeddings, dtype=np.float32)
+            self._labels = np.array(labels)
+            self._vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+        return self._labels, self._vectors
+
+
+# Shared by all conversations of the process
+router = IntentRouter()
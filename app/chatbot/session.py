@@ -0,0 +1,151 @@
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from app.chatbot.chatbot import Chatbot
+from app.chatbot.lead_chatbot import ABORTED_ANSWER, SUCCESS_ANSWER
+from app.config import settings
+from app.core.logger import get_logger
+
+logger = get_logger(__name__)
+
+# Lead data columns of the Summary table restored into Chatbot.lead_data
+LEAD_DATA_FIELDS = ["name", "email", "phone", "company", "company_size", "industry", "role",
+                    "interest", "pain", "budget", "additional_info"]
+
+
+# Per-conversation entry held by the SessionManager
+class Session:
+    __slots__ = ("bot", "last_access", "size")
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.last_access = time.monotonic()
+        self.size = estimate_size(bot)
+
+
+# Approximate memory footprint of a chatbot's conversation state in bytes
+def estimate_size(bot):
+    size = sum(sys.getsizeof(message) for message in bot.get_chat_history())
+    return size + sys.getsizeof(str(bot.get_lead_data()))
+
+
+# Keep one Chatbot per Papercups conversation with LRU/TTL eviction and a memory cap.
+# Evicted conversations are rehydrated through an AsyncDatabaseManager.
+class SessionManager:
+
+    def __init__(self,
+                 db_manager=None,
+                 max_sessions=settings.SESSION_MAX_SESSIONS,
+                 ttl=settings.SESSION_TTL_SECONDS,
+                 max_memory_mb=settings.SESSION_MAX_MEMORY_MB):
+        self.db_manager = db_manager
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.max_memory_bytes = max_memory_mb * 1024 * 1024
+        self._sessions = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    # Return the chatbot of a conversation, rehydrating it from the database if it was evicted.
+    # Loading happens outside of the lock so that slow queries do not block other conversations.
+    async def aget(self, conversation_id):
+        bot = self._lookup(conversation_id)
+        if bot is None:
+            bot = self._add(conversation_id, await self.aload(conversation_id))
+        return bot
+
+    # Drop a conversation from memory, e.g. after it was closed
+    def discard(self, conversation_id):
+        with self._lock:
+            session = self._sessions.pop(conversation_id, None)
+            if session is not None:
+                self._memory_bytes -= session.size
+
+    # Rebuild a chatbot from the conversations and summary tables
+    async def aload(self, conversation_id):
+        if self.db_manager is None:
+            return Chatbot()
+        try:
+            rows = await self.db_manager.load_conversation(conversation_id)
+            summary = await self.db_manager.load_summary(conversation_id)
+        except Exception as e:
+            logger.error(f"Unable to rehydrate conversation {conversation_id}: {e}")
+            return Chatbot()
+        return self.restore(conversation_id, rows, summary)
+
+    @staticmethod
+    def restore(conversation_id, rows, summary):
+        bot = Chatbot()
+        messages = []
+        lead_generation_status = "In Progress"
+        for row in rows:
+            if row.user_msg:
+                messages.append(("user", row.user_msg))
+            if row.bot_msg:
+                messages.append(("assistant", row.bot_msg))
+            if row.bot_msg == SUCCESS_ANSWER:
+                lead_generation_status = "Success"
+            elif row.bot_msg == ABORTED_ANSWER:
+                lead_generation_status = "Aborted"
+
+        lead_data = ""
+        if summary is not None:
+            lead_data = {field: getattr(summary, field) for field in LEAD_DATA_FIELDS}
+
+        bot.restore(messages, lead_generation_status, lead_data)
+        if rows:
+            logger.info(f"Rehydrated conversation {conversation_id} with {len(rows)} messages")
+        return bot
+
+    def _lookup(self, conversation_id):
+        with self._lock:
+            self._evict_expired()
+            session = self._sessions.get(conversation_id)
+            if session is None:
+                return None
+            self._touch(conversation_id, session)
+            return session.bot
+
+    # Keep the bot of another request if the conversation was loaded concurrently
+    def _add(self, conversation_id, bot):
+        with self._lock:
+            session = self._sessions.get(conversation_id)
+            if session is not None:
+                self._touch(conversation_id, session)
+                return session.bot
+            session = Session(bot)
+            self._sessions[conversation_id] = session
+            self._memory_bytes += session.size
+            self._evict_over_capacity()
+        return bot
+
+    # Mark a session as recently used and account for the growth of its history
+    def _touch(self, conversation_id, session):
+        self._sessions.move_to_end(conversation_id)
+        session.last_access = time.monotonic()
+        size = estimate_size(session.bot)
+        self._memory_bytes += size - session.size
+        session.size = size
+
+    def _evict_expired(self):
+        deadline = time.monotonic() - self.ttl
+        while self._sessions:
+            conversation_id, session = next(iter(self._sessions.items()))
+            if session.last_access > deadline:
+                break
+            self._evict(conversation_id)
+
+    def _evict_over_capacity(self):
+        while len(self._sessions) > 1 and (len(self._sessions) > self.max_sessions
+                                           or self._memory_bytes > self.max_memory_bytes):
+            self._evict(next(iter(self._sessions)))
+
+    def _evict(self, conversation_id):
+        session = self._sessions.pop(conversation_id)
+        self._memory_bytes -= session.size
+        logger.info(f"Evicted session {conversation_id} ({len(self._sessions)} sessions in memory)")
@@ -14,20 +14,81 @@ class Settings(BaseSettings):
     # Constants
     GPT_MODEL = "gpt-4"
     EMBEDDING_MODEL = "text-embedding-ada-002"
+
+    # Query consolidation of the retrieval chatbot
+    CONSOLIDATION_MODEL = os.getenv("CONSOLIDATION_MODEL", "gpt-3.5-turbo")
+    CONSOLIDATION_SKIP_SELF_CONTAINED = os.getenv("CONSOLIDATION_SKIP_SELF_CONTAINED", "true") == "true"
+    CONSOLIDATION_USE_ROUTER_QUERY = os.getenv("CONSOLIDATION_USE_ROUTER_QUERY", "true") == "true"
+
+    # Local intent routing, the LLM router is only called when the local router is not confident
+    ROUTER_LOCAL = os.getenv("ROUTER_LOCAL", "true") == "true"
+    ROUTER_MIN_CONFIDENCE = float(os.getenv("ROUTER_MIN_CONFIDENCE", 0.03))
+    ROUTER_NEIGHBORS = 3
+    # Search with the raw query while the turn is routed
+    SPECULATIVE_RETRIEVAL = os.getenv("SPECULATIVE_RETRIEVAL", "true") == "true"
+
+    # Local caches
+    CACHE_DIR = os.getenv("CACHE_DIR", ".cache")
+    EMBEDDING_CACHE_PATH = os.path.join(CACHE_DIR, "embeddings.sqlite")
+    EMBEDDING_CACHE_MEMORY_ENTRIES = 2048
+    EMBEDDING_CACHE_DISK_ENTRIES = 100000
+    ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "false") == "true"
+    ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", 0.95))
+    ANSWER_CACHE_MAX_ENTRIES = 1000
+    ANSWER_CACHE_TTL_SECONDS = 24 * 60 * 60
+    # Version of the vector index, a file next to the local store and an S3 object for Pinecone, which the
+    # indexing script and the API do not share a filesystem with
+    INDEX_VERSION_PATH = os.path.join(CACHE_DIR, "index_version")
+    INDEX_VERSION_KEY = os.getenv("INDEX_VERSION_KEY", "dev/index/version")
+    INDEX_VERSION_CHECK_INTERVAL = 60
     BASE_URL = os.getenv("PAPERCUPS_BASE_URL", "https://app.papercups.io")
 
+    # OpenAI client
+    OPENAI_TIMEOUT = int(os.getenv("OPENAI_TIMEOUT", 60))
+    OPENAI_EMBEDDING_TIMEOUT = int(os.getenv("OPENAI_EMBEDDING_TIMEOUT", 20))
+    OPENAI_MAX_RETRIES = 3
+    OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", 16))
+    EMBEDDING_TOKENS_PER_MINUTE = int(os.getenv("EMBEDDING_TOKENS_PER_MINUTE", 1000000))
+
     # Postgres Database
     POSTGRES_HOST = "db-postgresql-fra1-47508-do-user-14280808-0.b.db.ondigitalocean.com"
     POSTGRES_PORT = "25061"
     POSTGRES_NAME = "tcw-connection-pool"
     POSTGRES_USER = "doadmin"
     POSTGRES_PASSWORD = os.getenv('POSTGRES_PASSWORD')
+    POSTGRES_POOL_SIZE = int(os.getenv("POSTGRES_POOL_SIZE", 5))
+    POSTGRES_MAX_OVERFLOW = int(os.getenv("POSTGRES_MAX_OVERFLOW", 5))
+    POSTGRES_POOL_RECYCLE = 30 * 60
+
+    # Conversation rows are buffered by the API and written in batches
+    DB_WRITE_BATCH_SIZE = int(os.getenv("DB_WRITE_BATCH_SIZE", 100))
+    DB_WRITE_INTERVAL = float(os.getenv("DB_WRITE_INTERVAL", 1.0))
+    DB_WRITE_QUEUE_SIZE = 10000
 
     # Pinecone Vector Database
     PINECONE_API_KEY = os.getenv('PINECONE_API_KEY')
     PINECONE_INDEX_NAME = "tcw-website-embeddings-index"
     PINECONE_ENVIRONMENT = "us-west1-gcp-free"
 
+    # Vector store used for retrieval, either "pinecone" or "local"
+    VECTOR_STORE_BACKEND = os.getenv("VECTOR_STORE_BACKEND", "pinecone")
+    LOCAL_VECTOR_STORE_PATH = os.getenv("LOCAL_VECTOR_STORE_PATH", "data/vectorstore")
+
+    # Hybrid retrieval with a local BM25 keyword index
+    HYBRID_SEARCH = os.getenv("HYBRID_SEARCH", "true") == "true"
+    KEYWORD_INDEX_PATH = os.getenv("KEYWORD_INDEX_PATH", "data/keyword_index")
+    VECTOR_SEARCH_TIMEOUT = float(os.getenv("VECTOR_SEARCH_TIMEOUT", 3.0))
+
+    # Token budgets of the answer prompt
+    CONTEXT_MAX_TOKENS = int(os.getenv("CONTEXT_MAX_TOKENS", 1500))
+    HISTORY_MAX_TOKENS = int(os.getenv("HISTORY_MAX_TOKENS", 800))
+
+    # Conversation memory, older messages are rolled into a summary
+    MEMORY_MAX_MESSAGES = int(os.getenv("MEMORY_MAX_MESSAGES", 8))
+    MEMORY_SUMMARY_BATCH = 4
+    MEMORY_SUMMARY_MODEL = os.getenv("MEMORY_SUMMARY_MODEL", "gpt-3.5-turbo")
+    MEMORY_SUMMARY_WORKERS = 4
+
     # AWS S3 Bucket
     AWS_ACCESS_KEY_ID = os.getenv('AWS_ACCESS_KEY_ID')
     AWS_SECRET_ACCESS_KEY = os.getenv('AWS_SECRET_ACCESS_KEY')
@@ -35,5 +96,15 @@ class Settings(BaseSettings):
     AWS_REGION_NAME = "fra1"
     S3_BUCKET = 'tcw-chatbot'
 
+    # Conversation sessions
+    SESSION_MAX_SESSIONS = int(os.getenv("SESSION_MAX_SESSIONS", 5000))
+    SESSION_TTL_SECONDS = int(os.getenv("SESSION_TTL_SECONDS", 60 * 60))
+    SESSION_MAX_MEMORY_MB = int(os.getenv("SESSION_MAX_MEMORY_MB", 256))
+
+    # Webhook workers
+    WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 8))
+    WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", 50))
+    WEBHOOK_SHUTDOWN_TIMEOUT = 30
+
 
 settings = Settings()
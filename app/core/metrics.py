@@ -0,0 +1,53 @@
+import contextlib
+import threading
+import time
+from collections import deque
+
+
+# Rolling latency statistics over the most recent samples
+class LatencyStats:
+    def __init__(self, window=1000):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def observe(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+            self.count += 1
+
+    def percentile(self, p):
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        index = min(len(samples) - 1, int(round(p / 100 * (len(samples) - 1))))
+        return samples[index]
+
+    def summary(self):
+        p50, p95 = self.percentile(50), self.percentile(95)
+        return {
+            "count": self.count,
+            "p50_ms": round(p50 * 1000, 1) if p50 is not None else None,
+            "p95_ms": round(p95 * 1000, 1) if p95 is not None else None,
+        }
+
+
+# Durations of the stages of one request, stages may run in different threads
+class StageTimer:
+    def __init__(self):
+        self.stages = {}
+
+    def record(self, name, seconds):
+        self.stages[name] = seconds
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def __str__(self):
+        return " ".join(f"{name}={seconds * 1000:.0f}ms" for name, seconds in self.stages.items())
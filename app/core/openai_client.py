@@ -0,0 +1,136 @@
+import asyncio
+import contextlib
+import threading
+import weakref
+
+import aiohttp
+import openai
+import requests
+from requests.adapters import HTTPAdapter
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+
+from app.config import settings
+from app.core.logger import get_logger
+
+logger = get_logger(__name__)
+
+openai.api_key = settings.OPENAI_API_KEY
+
+
+# openai closes and replaces the session of a thread every few minutes. The shared session would then lose
+# the connections of all threads, it is only closed by close() on shutdown.
+class SharedSession(requests.Session):
+
+    def close(self):
+        pass
+
+    def shutdown(self):
+        super().close()
+
+
+# Share one keep-alive connection pool between all synchronous OpenAI calls
+http_session = SharedSession()
+http_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=settings.OPENAI_MAX_CONCURRENCY))
+openai.requestssession = http_session
+
+# Limit the number of concurrent requests across all threads of the process
+_semaphore = threading.BoundedSemaphore(settings.OPENAI_MAX_CONCURRENCY)
+
+# aiohttp sessions and semaphores are bound to an event loop, keep one per running loop
+_async_sessions = weakref.WeakKeyDictionary()
+_async_semaphores = weakref.WeakKeyDictionary()
+
+RETRYABLE_ERRORS = (
+    openai.error.APIConnectionError,
+    openai.error.APIError,
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.Timeout,
+)
+
+# Retry policy shared by all OpenAI calls
+openai_retry = retry(
+    wait=wait_random_exponential(min=1, max=40),
+    stop=stop_after_attempt(settings.OPENAI_MAX_RETRIES),
+    retry=retry_if_exception_type(RETRYABLE_ERRORS),
+    reraise=True,
+)
+
+
+@openai_retry
+def chat_completion(**kwargs):
+    kwargs.setdefault("request_timeout", settings.OPENAI_TIMEOUT)
+    with _semaphore:
+        return openai.ChatCompletion.create(**kwargs)
+
+
+# Retry only covers opening the stream, tokens that were already yielded cannot be retried
+_create_chat_completion = openai_retry(openai.ChatCompletion.create)
+
+
+# Stream a chat completion and yield the content tokens as they arrive. The concurrency limit only covers
+# opening the stream, a slow consumer of the tokens must not hold a slot of the other requests.
+def chat_completion_stream(**kwargs):
+    kwargs.setdefault("request_timeout", settings.OPENAI_TIMEOUT)
+    with _semaphore:
+        chunks = _create_chat_completion(stream=True, **kwargs)
+    for chunk in chunks:
+        content = chunk["choices"][0].get("delta", {}).get("content")
+        if content:
+            yield content
+
+
+@openai_retry
+def embedding(**kwargs):
+    kwargs.setdefault("request_timeout", settings.OPENAI_EMBEDDING_TIMEOUT)
+    with _semaphore:
+        return openai.Embedding.create(**kwargs)
+
+
+# Embed a list of texts and return the vectors in input order
+def embed_texts(texts, model=settings.EMBEDDING_MODEL):
+    response = embedding(input=texts, engine=model)
+    return [item["embedding"] for item in sorted(response["data"], key=lambda item: item["index"])]
+
+
+@contextlib.asynccontextmanager
+async def _async_request():
+    loop = asyncio.get_running_loop()
+    if loop not in _async_sessions:
+        connector = aiohttp.TCPConnector(limit=settings.OPENAI_MAX_CONCURRENCY, keepalive_timeout=60)
+        _async_sessions[loop] = aiohttp.ClientSession(connector=connector)
+        _async_semaphores[loop] = asyncio.Semaphore(settings.OPENAI_MAX_CONCURRENCY)
+    openai.aiosession.set(_async_sessions[loop])
+    async with _async_semaphores[loop]:
+        yield
+
+
+@openai_retry
+async def achat_completion(**kwargs):
+    kwargs.setdefault("request_timeout", settings.OPENAI_TIMEOUT)
+    async with _async_request():
+        return await openai.ChatCompletion.acreate(**kwargs)
+
+
+@openai_retry
+async def aembedding(**kwargs):
+    kwargs.setdefault("request_timeout", settings.OPENAI_EMBEDDING_TIMEOUT)
+    async with _async_request():
+        return await openai.Embedding.acreate(**kwargs)
+
+
+async def aembed_texts(texts, model=settings.EMBEDDING_MODEL):
+    response = await aembedding(input=texts, engine=model)
+    return [item["embedding"] for item in sorted(response["data"], key=lambda item: item["index"])]
+
+
+# Close the aiohttp session of the running event loop, e.g. on application shutdown
+async def aclose():
+    session = _async_sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None:
+        await session.close()
+
+
+# Close the connections of the synchronous calls, e.g. on application shutdown
+def close():
+    http_session.shutdown()
@@ -1,2 +1,3 @@
 from .models import Conversation, Summary
-from .manager import DatabaseManager
\ No newline at end of file
+from .manager import DatabaseManager
+from .async_manager import AsyncDatabaseManager
@@ -0,0 +1,104 @@
+import asyncio
+import time
+
+from sqlalchemy import insert, select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from app.config import settings
+from app.database.models import Conversation, Summary
+from app.database.writer import RowBuffer
+from app.core.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+# Async variant of DatabaseManager for the API, queries and batched conversation writes run on the event loop
+class AsyncDatabaseManager:
+
+    def __init__(self,
+                 host=settings.POSTGRES_HOST,
+                 port=settings.POSTGRES_PORT,
+                 db_name=settings.POSTGRES_NAME,
+                 user=settings.POSTGRES_USER,
+                 password=settings.POSTGRES_PASSWORD,
+                 batch_size=settings.DB_WRITE_BATCH_SIZE,
+                 flush_interval=settings.DB_WRITE_INTERVAL,
+                 max_buffered=settings.DB_WRITE_QUEUE_SIZE):
+
+        self.engine = create_async_engine(
+            f'postgresql+asyncpg://{user}:{password}@{host}:{port}/{db_name}',
+            pool_size=settings.POSTGRES_POOL_SIZE,
+            max_overflow=settings.POSTGRES_MAX_OVERFLOW,
+            pool_pre_ping=True,
+            pool_recycle=settings.POSTGRES_POOL_RECYCLE,
+            # The managed database is reached through PgBouncer in transaction mode, where prepared
+            # statements of one transaction may end up on another server connection
+            connect_args={"statement_cache_size": 0, "prepared_statement_cache_size": 0},
+        )
+        self.Session = async_sessionmaker(self.engine, expire_on_commit=False)
+        self.flush_interval = flush_interval
+        self._buffer = RowBuffer(Conversation, batch_size, max_buffered)
+        self._write_lock = None
+        self._timer = None
+        # Flushes started for full batches, referenced until done so they are not garbage collected
+        self._tasks = set()
+
+    # Start the periodic flush, must be called from the running event loop
+    async def start(self):
+        self._write_lock = asyncio.Lock()
+        self._timer = asyncio.create_task(self._flush_periodically())
+
+    # Write the queued rows and release all connections
+    async def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            await asyncio.gather(self._timer, return_exceptions=True)
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self.flush()
+        await self.engine.dispose()
+
+    # Queue a conversation row given as dict of column values, full batches are written right away
+    def queue_conversation(self, data_dict):
+        if self._buffer.add(data_dict) and self._write_lock is not None:
+            task = asyncio.get_running_loop().create_task(self.flush())
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    # Insert all queued rows, see RowBuffer for the handling of failed rows
+    async def flush(self):
+        if self._write_lock is None:
+            self._write_lock = asyncio.Lock()
+        async with self._write_lock:
+            while len(self._buffer):
+                rows = self._buffer.next_batch()
+                start = time.perf_counter()
+                try:
+                    async with self.engine.begin() as connection:
+                        await connection.execute(insert(Conversation), rows)
+                except Exception as error:
+                    if not self._buffer.done(rows, error):
+                        return
+                    continue
+                self._buffer.done(rows)
+                elapsed = (time.perf_counter() - start) * 1000
+                logger.info(f"Inserted {len(rows)} conversations rows in {elapsed:.0f} ms")
+
+    # Load all messages of a conversation ordered by time
+    async def load_conversation(self, conversation_id):
+        # The latest messages may still be queued
+        await self.flush()
+        async with self.Session() as session:
+            result = await session.scalars(select(Conversation)
+                                           .where(Conversation.conversation_id == conversation_id)
+                                           .order_by(Conversation.created_at))
+            return result.all()
+
+    # Load the extracted lead data of a conversation if available
+    async def load_summary(self, conversation_id):
+        async with self.Session() as session:
+            return await session.get(Summary, conversation_id)
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
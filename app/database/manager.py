@@ -14,12 +14,18 @@ class DatabaseManager:
                  user=settings.POSTGRES_USER,
                  password=settings.POSTGRES_PASSWORD):
 
-        self.engine = create_engine(f'postgresql://{user}:{password}@{host}:{port}/{db_name}')
+        self.engine = create_engine(
+            f'postgresql://{user}:{password}@{host}:{port}/{db_name}',
+            pool_size=settings.POSTGRES_POOL_SIZE,
+            max_overflow=settings.POSTGRES_MAX_OVERFLOW,
+            # Connections of the managed database are closed when idle, check them before use
+            pool_pre_ping=True,
+            pool_recycle=settings.POSTGRES_POOL_RECYCLE,
+        )
+        self.Session = sessionmaker(bind=self.engine)
 
     def create_session(self):
-        Session = sessionmaker(bind=self.engine)
-        session = Session()
-        return session
+        return self.Session()
 
     def write_to_db(self, obj):
         session = self.create_session()
@@ -33,5 +39,6 @@ class DatabaseManager:
         finally:
             session.close()
 
-
-
+    # Release all connections, e.g. at the end of a script
+    def close(self):
+        self.engine.dispose()
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, DateTime
+from sqlalchemy import Column, String, DateTime, Index
 from sqlalchemy.orm import declarative_base
 
 Base = declarative_base()
@@ -12,11 +12,19 @@ class Conversation(Base):
     bot_msg = Column(String)
     created_at = Column(DateTime)
 
+    # Messages are looked up per conversation in time order, conversations are listed by time
+    __table_args__ = (
+        Index("ix_conversations_conversation_id_created_at", "conversation_id", "created_at"),
+        Index("ix_conversations_created_at", "created_at"),
+    )
+
 class Summary(Base):
     __tablename__ = 'summary'
     conversation_id = Column(String(64), primary_key=True)
     user_id = Column(String(64))
     created_at = Column(DateTime)
+    # Time of the latest message included in the summary
+    summarized_until = Column(DateTime)
     name = Column(String(128))
     email = Column(String(128))
     phone = Column(String(128))
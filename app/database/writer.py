@@ -0,0 +1,68 @@
+import asyncio
+
+from sqlalchemy import exc
+
+from app.config import settings
+from app.core.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+# Errors after which the database is likely to accept the same rows again later
+TRANSIENT_ERRORS = (exc.OperationalError, exc.InterfaceError, exc.DisconnectionError, OSError,
+                    asyncio.TimeoutError)
+
+
+# Rows waiting to be inserted into a table. A batch that fails is retried row by row, so that a bad row
+# is dropped instead of blocking all later rows. After connection errors all rows are kept for the next flush.
+class RowBuffer:
+
+    def __init__(self, model, batch_size=settings.DB_WRITE_BATCH_SIZE, max_rows=settings.DB_WRITE_QUEUE_SIZE):
+        self.model = model
+        self.batch_size = batch_size
+        self.max_rows = max_rows
+        self.written = 0
+        self.dropped = 0
+        self._rows = []
+        # Number of rows at the start of the buffer that are retried one at a time
+        self._single = 0
+
+    def __len__(self):
+        return len(self._rows)
+
+    # Add a row given as dict of column values, returns True once a full batch is buffered
+    def add(self, row):
+        self._rows.append(row)
+        if len(self._rows) > self.max_rows:
+            # The database has been unavailable for too long, give up on the oldest row
+            self._drop("buffer full")
+        return len(self._rows) >= self.batch_size
+
+    # Rows to insert next, a single row while a failed batch is retried
+    def next_batch(self):
+        return self._rows[:1 if self._single else self.batch_size]
+
+    # Report the result of inserting the rows of next_batch(), returns False if writing should pause
+    def done(self, rows, error=None):
+        table = self.model.__tablename__
+        if error is None:
+            del self._rows[:len(rows)]
+            self._single = max(0, self._single - len(rows))
+            self.written += len(rows)
+            return True
+        if isinstance(error, TRANSIENT_ERRORS):
+            logger.error(f"Unable to write {len(rows)} {table} rows, retrying later: {error}")
+            return False
+        if len(rows) > 1:
+            logger.warning(f"Unable to write a batch of {len(rows)} {table} rows, retrying row by row: {error}")
+            self._single = len(rows)
+            return True
+        self._drop(error)
+        return True
+
+    def _drop(self, reason):
+        row = self._rows.pop(0)
+        self._single = max(0, self._single - 1)
+        self.dropped += 1
+        key = ", ".join(str(row.get(column.name)) for column in self.model.__table__.primary_key.columns)
+        logger.error(f"Dropped {self.model.__tablename__} row {key}: {reason}")
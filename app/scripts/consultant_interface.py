@@ -4,71 +4,116 @@
 3. Run the script via: % streamlit run app/scripts/consultant_interface.py
 """
 
+import math
+
 import streamlit as st
 import pandas as pd
 import openai
+from sqlalchemy import func, or_, select
 
 from app.database import DatabaseManager, Conversation, Summary
 from app.config import settings
 
+# Conversations per page and lifetime of cached query results in seconds
+PAGE_SIZE = 50
+CACHE_TTL = 60
 
-openai.api_key = settings.OPENAI_API_KEY
-db_manager = DatabaseManager()
-db_session = db_manager.create_session()
+# Summary columns shown in the dashboard
+SUMMARY_COLUMNS = [Summary.conversation_id, Summary.user_id, Summary.name, Summary.email, Summary.phone,
+                   Summary.company, Summary.company_size, Summary.industry, Summary.role, Summary.interest,
+                   Summary.pain, Summary.budget, Summary.additional_info]
 
-# List all conversations from database
-def list_conversations(session):
-    conversations = session.query(
-        Conversation.conversation_id,
-        Conversation.user_id).distinct().all()
 
-    return conversations
+openai.api_key = settings.OPENAI_API_KEY
 
-# Retrieve a conversation from database
-def fetch_conversation(session, conversation_id):
-    conversation = session.query(Conversation).filter_by(
-        conversation_id=conversation_id).order_by(
-        Conversation.created_at).all()
 
+# One pooled engine shared by all sessions and reruns of the dashboard
+@st.cache_resource
+def get_engine():
+    return DatabaseManager().engine
+
+
+# Filter conversations by id, user id or the name, email or company of their summary
+def search_filter(query, search):
+    if not search:
+        return query
+    pattern = f"%{search}%"
+    return (query.outerjoin(Summary, Summary.conversation_id == Conversation.conversation_id)
+            .where(or_(Conversation.conversation_id.ilike(pattern),
+                       Conversation.user_id.ilike(pattern),
+                       Summary.name.ilike(pattern),
+                       Summary.email.ilike(pattern),
+                       Summary.company.ilike(pattern))))
+
+
+@st.cache_data(ttl=CACHE_TTL)
+def count_conversations(search=""):
+    query = search_filter(select(func.count(func.distinct(Conversation.conversation_id))), search)
+    with get_engine().connect() as connection:
+        return connection.execute(query).scalar()
+
+
+# List a page of conversations, the most recently active first
+@st.cache_data(ttl=CACHE_TTL)
+def list_conversations(search="", page=1):
+    last_message_at = func.max(Conversation.created_at).label("last_message_at")
+    query = search_filter(
+        select(Conversation.conversation_id,
+               func.min(Conversation.user_id).label("user_id"),
+               last_message_at,
+               func.count().label("messages"))
+        .group_by(Conversation.conversation_id), search)
+    query = (query.order_by(last_message_at.desc(), Conversation.conversation_id)
+             .limit(PAGE_SIZE).offset((page - 1) * PAGE_SIZE))
+    with get_engine().connect() as connection:
+        return [dict(row) for row in connection.execute(query).mappings()]
+
+
+# Retrieve the messages of a conversation from database
+@st.cache_data(ttl=CACHE_TTL)
+def fetch_conversation(conversation_id):
+    query = (select(Conversation.user_msg, Conversation.bot_msg)
+             .where(Conversation.conversation_id == conversation_id)
+             .order_by(Conversation.created_at))
     conversation_str = []
-    for msg in conversation:
-        if msg.user_msg:
-            conversation_str.append(("User", f"{msg.user_msg}\n"))
-        if msg.bot_msg:
-            conversation_str.append(("Assistant", f"{msg.bot_msg}\n"))
-
-    user_conversation = {
-        "user_id": conversation[0].user_id,
-        "conversation_id": conversation_id,
-        "conversation_str": conversation_str
-    }
-
-    return user_conversation
-
-
-convos = list_conversations(db_session)
-conversation_ids = [conversation[0] for conversation in convos]
-
-selected_option = st.selectbox('Select an option:', conversation_ids)
-
-text_data = fetch_conversation(db_session, selected_option)
+    with get_engine().connect() as connection:
+        for user_msg, bot_msg in connection.execute(query):
+            if user_msg:
+                conversation_str.append(("User", f"{user_msg}\n"))
+            if bot_msg:
+                conversation_str.append(("Assistant", f"{bot_msg}\n"))
+    return conversation_str
+
+
+# Load only the displayed columns of a summary
+@st.cache_data(ttl=CACHE_TTL)
+def fetch_summary(conversation_id):
+    query = select(*SUMMARY_COLUMNS).where(Summary.conversation_id == conversation_id)
+    with get_engine().connect() as connection:
+        row = connection.execute(query).mappings().first()
+    return dict(row) if row is not None else None
+
+
+search = st.text_input("Search by conversation, user, name, email or company:").strip()
+total = count_conversations(search)
+page = st.number_input(f"Page (of {max(1, math.ceil(total / PAGE_SIZE))}):",
+                       min_value=1, max_value=max(1, math.ceil(total / PAGE_SIZE)), value=1)
+
+convos = list_conversations(search, page)
+if not convos:
+    st.info("No conversations found.")
+    st.stop()
+
+labels = {convo["conversation_id"]: f"{convo['conversation_id']} ({convo['last_message_at']:%Y-%m-%d %H:%M}, "
+                                    f"{convo['messages']} messages)" for convo in convos}
+selected_option = st.selectbox('Select an option:', list(labels), format_func=labels.get)
 
 with st.expander("Conversation"):
-    for sender, message in text_data["conversation_str"]:
+    for sender, message in fetch_conversation(selected_option):
         st.markdown(f"**{sender}**: {message}")
 
-summary_data = db_session.query(Summary).filter_by(conversation_id=selected_option).all()
-
-df = pd.DataFrame([obj.__dict__ for obj in summary_data])
-df.drop(["_sa_instance_state"], axis=1, inplace=True)
-df = df.drop(['created_at'], axis=1)
-
-
-
-df = df.transpose()
-
-st.table(df)
-
-db_session.close()
-
-
+summary_data = fetch_summary(selected_option)
+if summary_data is None:
+    st.info("No lead data extracted for this conversation yet.")
+else:
+    st.table(pd.DataFrame([summary_data]).transpose())
@@ -1,11 +1,17 @@
 # Import packages
-import urllib.parse
+import argparse
+import hashlib
+import json
+import os
 import re
+import threading
+import time
 import requests
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from requests.adapters import HTTPAdapter
 from urllib.parse import urlparse, urlunparse
-from collections import deque
 from html.parser import HTMLParser
-import urllib.request
 import boto3
 import botocore.session
 import datetime
@@ -23,6 +29,15 @@ URL_BLACKLIST = [
     "https://tcw.de/impressum",
     "https://tcw.de/news",
 ]
+WORKERS = 8
+MAX_CONNECTIONS_PER_HOST = 4
+REQUEST_DELAY = 0.1
+UPLOAD_WORKERS = 4
+UPLOAD_BATCH_SIZE = 20
+MANIFEST_PATH = "data/crawler/manifest.json"
+CHANGES_PATH = "data/crawler/changes.json"
+# Status codes that mean a page was removed, other errors keep the page of the previous crawl
+GONE_STATUS_CODES = (404, 410)
 
 # Initialize S3 client to store crawled pages
 session = boto3.session.Session()
@@ -46,39 +61,19 @@ class HyperlinkParser(HTMLParser):
         if tag in ["a", "link"] and "href" in attrs:
             self.hyperlinks.add(attrs["href"])
 
-    # Parse the given URL to extract hyperlinks
-    def parse(self, url):
-        try:
-            response = requests.get(url)
-            if response.headers.get('content-type') != 'text/html':
-                return []
-            html = response.text
-            self.feed(html)
-        except requests.exceptions.RequestException as e:
-            logging.error(e)
-            return []
-
-        return list(self.hyperlinks)
-
-# Function to get hyperlinks from a given URL
-def get_hyperlinks(url):
+# Function to get hyperlinks from the HTML of a page
+def get_hyperlinks(html):
+    parser = HyperlinkParser()
     try:
-        with urllib.request.urlopen(url) as response:
-            if response.info().get_content_type() != "text/html":
-                return []
-            html = response.read().decode('utf-8')
+        parser.feed(html)
     except Exception as e:
         logging.error(e)
-        return []
-
-    parser = HyperlinkParser()
-    parser.feed(html)
     return parser.hyperlinks
 
-# Function to get hyperlinks that belong to the same domain as the given URL
-def get_domain_hyperlinks(local_domain, url):
+# Function to get hyperlinks that belong to the same domain as the given page
+def get_domain_hyperlinks(local_domain, html):
     clean_links = set()
-    for link in get_hyperlinks(url):
+    for link in get_hyperlinks(html):
         if re.search(HTTP_URL_PATTERN, link):
             url_obj = urlparse(link)
             netloc = url_obj.netloc.replace('www.', '')
@@ -97,7 +92,7 @@ def get_domain_hyperlinks(local_domain, url):
 def is_blacklisted(url):
     return any(blacklisted_url in url for blacklisted_url in URL_BLACKLIST)
 
-# Function to write scraped content to an AWS S3 bucket
+# Function to write scraped content to an AWS S3 bucket, returns whether the upload succeeded
 def write_to_s3(local_domain, filename, html_content, metadata):
     try:
         client.put_object(
@@ -107,42 +102,221 @@ def write_to_s3(local_domain, filename, html_content, metadata):
             ACL='private',
             Metadata=metadata
         )
+        return True
     except Exception as e:
-        logging.error(e)
+        logging.error(f"Failed to upload {filename} due to {e}.")
+        return False
+
+# Function to write a batch of pages to S3, returns the filenames that were uploaded
+def write_batch_to_s3(local_domain, pages):
+    uploaded = [filename for filename, html_content, metadata in pages
+                if write_to_s3(local_domain, filename, html_content, metadata)]
+    logging.info(f"Uploaded {len(uploaded)} of {len(pages)} pages to S3")
+    return uploaded
+
+# Function to delete pages that no longer exist from S3, returns the filenames that were deleted
+def delete_batch_from_s3(local_domain, filenames):
+    deleted = []
+    for filename in filenames:
+        try:
+            client.delete_object(Bucket='tcw-chatbot', Key=f'dev/scraper/{local_domain}/{filename}')
+            deleted.append(filename)
+        except Exception as e:
+            logging.error(f"Failed to delete {filename} due to {e}.")
+    logging.info(f"Deleted {len(deleted)} of {len(filenames)} pages from S3")
+    return deleted
+
+# Limit concurrent requests and request rate per host
+class HostLimiter:
+    def __init__(self, max_connections=MAX_CONNECTIONS_PER_HOST, delay=REQUEST_DELAY):
+        self.max_connections = max_connections
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.semaphores = {}
+        self.next_request = {}
+
+    @contextmanager
+    def limit(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            semaphore = self.semaphores.setdefault(host, threading.BoundedSemaphore(self.max_connections))
+        with semaphore:
+            # Reserve the next free time slot of the host
+            with self.lock:
+                now = time.monotonic()
+                start = max(now, self.next_request.get(host, now))
+                self.next_request[host] = start + self.delay
+            time.sleep(max(0.0, start - now))
+            yield
+
+# Load the manifest of the previous crawl
+def load_manifest(path=MANIFEST_PATH):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+# Write a JSON file, replacing the previous version atomically
+def write_json(path, data):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(f"{path}.tmp", path)
 
 # Crawler class for web scraping
 class Crawler:
-    def __init__(self, start_url):
+    def __init__(self, start_url, workers=WORKERS, upload_workers=UPLOAD_WORKERS, upload_batch_size=UPLOAD_BATCH_SIZE,
+                 limiter=None, manifest=None):
         self.local_domain = urlparse(start_url).netloc
-        self.queue = deque([start_url])
+        self.start_url = start_url
         self.seen = {start_url}
+        self.workers = workers
+        self.upload_workers = upload_workers
+        self.upload_batch_size = upload_batch_size
+        self.limiter = limiter or HostLimiter()
+        # Manifest of the previous crawl, enables conditional requests and skipping unchanged pages
+        self.previous = manifest or {}
+        self.manifest = {}
+        self.changes = {"added": [], "modified": [], "removed": []}
+        # Reuse connections across requests of all workers
+        self.http = requests.Session()
+        self.http.mount("https://", HTTPAdapter(pool_maxsize=workers))
+        self.http.mount("http://", HTTPAdapter(pool_maxsize=workers))
+
+    # Download a page once, its HTML is used for storage and link extraction
+    def fetch(self, url):
+        headers = {}
+        previous = self.previous.get(url)
+        if previous and previous.get("etag"):
+            headers["If-None-Match"] = previous["etag"]
+        if previous and previous.get("last_modified"):
+            headers["If-Modified-Since"] = previous["last_modified"]
+        try:
+            with self.limiter.limit(url):
+                return self.http.get(url, headers=headers, timeout=5)
+        except requests.exceptions.RequestException as e:
+            logging.error(f"Failed to fetch {url} due to {e}.")
+            return None
+
+    # Compare a response with the previous crawl, returns the manifest entry and whether the page must be uploaded
+    def check_page(self, url, response):
+        previous = self.previous.get(url)
+        if response.status_code == 304 and previous:
+            return previous, False
+        if not response.ok and response.status_code not in GONE_STATUS_CODES and previous:
+            # Keep pages with transient errors such as 429 or 5xx, their stored links are still followed
+            logging.error(f"Failed to fetch {url} with status {response.status_code}, keeping previous version.")
+            return previous, False
+        if not response.ok or not response.headers.get('Content-Type', '').startswith('text/html'):
+            return None, False
+
+        entry = {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "hash": hashlib.sha256(response.content).hexdigest(),
+            "filename": f'{url[8:].replace("/", "_")}.html',
+            "links": get_domain_hyperlinks(self.local_domain, response.text),
+        }
+        if previous is None:
+            self.changes["added"].append(url)
+        elif previous["hash"] != entry["hash"]:
+            self.changes["modified"].append(url)
+        else:
+            return entry, False
+        return entry, True
 
     # Main crawl function
     def crawl(self):
-        while self.queue:
-            url = self.queue.popleft()
-            try:
-                response = requests.get(url, timeout=5)  # Added a timeout for the request
-            except requests.exceptions.RequestException as e:
-                logging.error(f"Failed to fetch {url} due to {e}.")
-                continue
-
-            if response.headers.get('Content-Type', '').startswith('text/html'):
-                metadata = {
-                    'Source-url': url,
-                    'Content-type': response.headers.get('Content-Type'),
-                    'Created-at': datetime.date.today().strftime("%Y-%m-%d")
-                }
-                logging.info(f"Crawled {url} - ({len(self.queue)} URLs in queue)")
-                write_to_s3(self.local_domain, f'{url[8:].replace("/", "_")}.html', response.text, metadata)
-
-            for link in get_domain_hyperlinks(self.local_domain, url):
-                if link not in self.seen and not is_blacklisted(link):
-                    self.queue.append(link)
-                    self.seen.add(link)
+        start = time.monotonic()
+        reached = set()
+        # Changed pages by filename, they enter the manifest once their upload succeeded
+        changed_pages = {}
+        batch = []
+        uploads = []
+        with ThreadPoolExecutor(self.workers) as fetch_pool, ThreadPoolExecutor(self.upload_workers) as upload_pool:
+            pending = {fetch_pool.submit(self.fetch, self.start_url): self.start_url}
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    url = pending.pop(future)
+                    response = future.result()
+                    if response is None and url in self.previous:
+                        # Keep pages that could not be fetched this time instead of removing them
+                        entry, changed = self.previous[url], False
+                    elif response is None:
+                        continue
+                    else:
+                        entry, changed = self.check_page(url, response)
+                    if entry is None:
+                        continue
+
+                    reached.add(url)
+                    logging.info(f"Crawled {url} ({'changed' if changed else 'unchanged'}) - ({len(pending)} URLs in queue)")
+                    if changed:
+                        metadata = {
+                            'Source-url': url,
+                            'Content-type': response.headers.get('Content-Type'),
+                            'Content-hash': entry["hash"],
+                            'Created-at': datetime.date.today().strftime("%Y-%m-%d")
+                        }
+                        changed_pages[entry["filename"]] = (url, entry)
+                        batch.append((entry["filename"], response.text, metadata))
+                    else:
+                        self.manifest[url] = entry
+                    if len(batch) >= self.upload_batch_size:
+                        uploads.append(upload_pool.submit(write_batch_to_s3, self.local_domain, batch))
+                        batch = []
+
+                    for link in entry["links"]:
+                        if link not in self.seen and not is_blacklisted(link):
+                            self.seen.add(link)
+                            pending[fetch_pool.submit(self.fetch, link)] = link
+
+            if batch:
+                uploads.append(upload_pool.submit(write_batch_to_s3, self.local_domain, batch))
+
+            # Pages of the previous crawl that were not reached again are removed from S3
+            removed = {self.previous[url]["filename"]: url for url in self.previous if url not in reached}
+            deletion = upload_pool.submit(delete_batch_from_s3, self.local_domain, list(removed)) if removed else None
+
+            for upload in uploads:
+                for filename in upload.result():
+                    url, entry = changed_pages.pop(filename)
+                    self.manifest[url] = entry
+            for deleted in (deletion.result() if deletion else []):
+                self.changes["removed"].append(removed.pop(deleted))
+
+        # Failed uploads keep the previous entry, so that the next incremental crawl uploads them again
+        for url, entry in changed_pages.values():
+            for change in ("added", "modified"):
+                if url in self.changes[change]:
+                    self.changes[change].remove(url)
+            if url in self.previous:
+                self.manifest[url] = self.previous[url]
+        # Failed deletes stay in the manifest and are retried by the next crawl
+        for url in removed.values():
+            self.manifest[url] = self.previous[url]
+
+        logging.info(f"Crawled {len(self.manifest)} pages in {time.monotonic() - start:.1f} seconds: "
+                     f"{len(self.changes['added'])} added, {len(self.changes['modified'])} modified, "
+                     f"{len(self.changes['removed'])} removed")
+        return self.changes
 
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
-    crawler = Crawler(FULL_URL)
-    crawler.crawl()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Crawl the TCW website and store the pages in S3")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="number of concurrent downloads")
+    parser.add_argument("--per-host", type=int, default=MAX_CONNECTIONS_PER_HOST,
+                        help="maximum number of concurrent requests per host")
+    parser.add_argument("--delay", type=float, default=REQUEST_DELAY,
+                        help="minimum delay in seconds between requests to the same host")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only upload pages that changed since the last crawl")
+    args = parser.parse_args()
+    manifest = load_manifest() if args.incremental else None
+    crawler = Crawler(FULL_URL, workers=args.workers, limiter=HostLimiter(args.per_host, args.delay), manifest=manifest)
+    changes = crawler.crawl()
+    write_json(MANIFEST_PATH, crawler.manifest)
+    write_json(CHANGES_PATH, changes)
@@ -0,0 +1,57 @@
+import hashlib
+import re
+from collections import defaultdict
+
+import numpy as np
+
+from app.core.logger import get_logger
+
+logger = get_logger(__name__)
+
+# MinHash parameters: 128 permutations split into 16 LSH bands of 8 rows find candidate pairs
+# above a Jaccard similarity of roughly 0.7, which are then checked against THRESHOLD
+SHINGLE_SIZE = 5
+NUM_PERMUTATIONS = 128
+BANDS = 16
+THRESHOLD = 0.85
+MERSENNE_PRIME = (1 << 31) - 1
+
+_rng = np.random.default_rng(42)
+_a = _rng.integers(1, MERSENNE_PRIME, size=NUM_PERMUTATIONS, dtype=np.uint64)
+_b = _rng.integers(0, MERSENNE_PRIME, size=NUM_PERMUTATIONS, dtype=np.uint64)
+
+
+# Word shingles of a text, short texts are a single shingle
+def shingles(text, size=SHINGLE_SIZE):
+    words = re.findall(r"\w+", text.lower())
+    if len(words) <= size:
+        return {" ".join(words)}
+    return {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def minhash(text):
+    values = np.array([int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "little")
+                       % MERSENNE_PRIME for shingle in shingles(text)], dtype=np.uint64)
+    return ((np.outer(values, _a) + _b) % MERSENNE_PRIME).min(axis=0)
+
+
+# Drop chunks whose text is a near duplicate of an earlier chunk, given as (id, text, metadata).
+# The first occurrence is kept so that the result only depends on the order of the chunks.
+def remove_near_duplicates(chunks, threshold=THRESHOLD):
+    rows = NUM_PERMUTATIONS // BANDS
+    buckets = defaultdict(list)
+    signatures = []
+    kept = []
+    for chunk in chunks:
+        signature = minhash(chunk[1])
+        keys = [(band, signature[band * rows:(band + 1) * rows].tobytes()) for band in range(BANDS)]
+        candidates = {i for key in keys for i in buckets.get(key, [])}
+        if any(np.mean(signatures[i] == signature) >= threshold for i in candidates):
+            continue
+        for key in keys:
+            buckets[key].append(len(signatures))
+        signatures.append(signature)
+        kept.append(chunk)
+
+    logger.info(f"Removed {len(chunks) - len(kept)} near-duplicate chunks, {len(kept)} chunks left")
+    return kept
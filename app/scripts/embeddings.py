@@ -1,18 +1,38 @@
+import argparse
+import hashlib
+import json
+import os
 import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import boto3
+import tiktoken
 import botocore.config
 from bs4 import BeautifulSoup
-from uuid import uuid4
-import pinecone
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.embeddings import OpenAIEmbeddings
+from app.chatbot.answer_cache import mark_index_rebuilt
 from app.config import settings
+from app.core import openai_client
 from unstructured.partition.html import partition_html
 from unstructured.staging.base import convert_to_dict
 from app.core.logger import get_logger
+from app.scripts.dedup import remove_near_duplicates
+from app.vectorstore import KeywordIndex, get_vector_store
 
 logger = get_logger(__name__)
 
+INDEX_MANIFEST_DIR = "data/index"
+S3_WORKERS = 8
+PARTITION_WORKERS = os.cpu_count() or 1
+PARTITION_CHUNK_SIZE = 8
+EMBEDDING_WORKERS = 4
+EMBEDDING_BATCH_TOKENS = 20000
+EMBEDDING_BATCH_SIZE = 256
+EMBEDDING_RETRIES = 2
+UPSERT_WORKERS = 2
+
 # Set up S3 client to read HTML files from
 session = boto3.session.Session()
 s3_client = session.client('s3',
@@ -22,47 +42,101 @@ s3_client = session.client('s3',
                            aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
                            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY)
 
-# Read files from S3 bucket
-def read_files_from_s3(bucket=settings.S3_BUCKET):
-    logger.info("Read files from S3 Bucket into memory")
-    prefix = 'dev/scraper/tcw.de/'
-    html_content = []
+# Download a single object from S3
+def read_file_from_s3(bucket, key):
+    data = s3_client.get_object(Bucket=bucket, Key=key)
+    return {'page_content': data['Body'].read(),
+            'metadata': data['Metadata']}
+
+# Stream files from S3 bucket. Objects are listed page by page and downloaded concurrently,
+# with at most 2 * workers downloads in flight, and yielded in listing order.
+# Listing errors are raised, the keys of failed downloads are appended to failed_keys.
+def read_files_from_s3(bucket=settings.S3_BUCKET, prefix='dev/scraper/tcw.de/', workers=S3_WORKERS, failed_keys=None):
+    logger.info(f"Stream files from s3://{bucket}/{prefix}")
+    paginator = s3_client.get_paginator('list_objects_v2')
+    in_flight = deque()
+    count = 0
+    failed_keys = [] if failed_keys is None else failed_keys
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        try:
+            for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+                for obj in page.get('Contents', []):
+                    in_flight.append((obj['Key'], pool.submit(read_file_from_s3, bucket, obj['Key'])))
+                    if len(in_flight) >= 2 * workers:
+                        count += yield from _collect(in_flight.popleft(), failed_keys)
+        except Exception as e:
+            logger.error(f"Error listing files in s3://{bucket}/{prefix}: {e}")
+            for _, future in in_flight:
+                future.cancel()
+            raise
+        while in_flight:
+            count += yield from _collect(in_flight.popleft(), failed_keys)
+    if count == 0 and not failed_keys:
+        logger.info(f"No objects found in s3://{bucket}/{prefix}")
+    else:
+        logger.info(f"Read {count} files from S3, {len(failed_keys)} downloads failed")
+
+def _collect(download, failed_keys):
+    key, future = download
     try:
-        response = s3_client.list_objects(Bucket=bucket, Prefix=prefix)
-        if 'Contents' not in response:
-            logger.info(f"No objects found in s3://{bucket}/{prefix}")
-            return
-        for obj in response.get('Contents', []):
-            data = s3_client.get_object(Bucket=bucket, Key=obj['Key'])
-            entry = {'page_content': data['Body'].read(),
-                     'metadata': data['Metadata']}
-            html_content.append(entry)
+        result = future.result()
     except Exception as e:
-        logger.error(f"Error downloading files from s3: {e}")
-    return html_content
+        logger.error(f"Error downloading s3 object {key}: {e}")
+        failed_keys.append(key)
+        return 0
+    yield result
+    return 1
 
 # Preprocess HTML content by reading relevant HTML class
-def html_preprocessing(html_list):
-    logger.info("Retrieve relevant HTML class")
-    for html_file in html_list:
-        soup = BeautifulSoup(html_file['page_content'], "html.parser")
-        html_file['page_content'] = str(soup.find("div", class_="content_frame_out"))
-    return html_list
+def html_preprocessing(page_content):
+    soup = BeautifulSoup(page_content, "html.parser")
+    return str(soup.find("div", class_="content_frame_out"))
+
+# Extract the text elements of a single page, runs in a worker process
+def partition_page(html_file):
+    # Extract structured elements from HTML via unstructured package
+    partitioned_html = partition_html(text=html_preprocessing(html_file['page_content']),
+                                      strategy="hi_res", include_metadata=False)
+    html_elements = convert_to_dict(partitioned_html)
+    # only keep relevant elements from extracted elements
+    return [{'type': element.get('type'), 'text': element.get('text'), 'metadata': html_file['metadata']}
+            for element in html_elements]
+
+def partition_batch(html_files):
+    return [partition_page(html_file) for html_file in html_files]
+
+# Partition pages in a process pool, batches of chunk_size pages are distributed to the workers
+# and the results are yielded page by page in input order
+def partition_pages(html_files, workers=PARTITION_WORKERS, chunk_size=PARTITION_CHUNK_SIZE):
+    if workers <= 1:
+        for html_file in html_files:
+            yield partition_page(html_file)
+        return
+
+    in_flight = deque()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        batch = []
+        for html_file in html_files:
+            batch.append(html_file)
+            if len(batch) >= chunk_size:
+                in_flight.append(pool.submit(partition_batch, batch))
+                batch = []
+            if len(in_flight) >= 2 * workers:
+                yield from in_flight.popleft().result()
+        if batch:
+            in_flight.append(pool.submit(partition_batch, batch))
+        while in_flight:
+            yield from in_flight.popleft().result()
 
 # Convert HTML to text
-def html_to_text(html_list):
-    logger.info("Convert HTML to text")
+def html_to_text(html_files, workers=PARTITION_WORKERS):
+    logger.info(f"Convert HTML to text ({workers} workers)")
     text_elements = []
     seen = set()
 
-    for html_file in html_list:
-        # Extract structured elements from HTML via unstructured package
-        partitioned_html = partition_html(text=html_file['page_content'], strategy="hi_res", include_metadata=False)
-        html_elements = convert_to_dict(partitioned_html)
-        # remove duplicates and only keep relevant elements from extracted elements
-        for element in html_elements:
-            element['metadata'] = html_file['metadata']
-            element = {k: v for k, v in element.items() if k in ['type', 'text', 'metadata']}
+    # Merge step: remove duplicates across pages in page order so that the result is deterministic
+    for page_elements in partition_pages(html_files, workers):
+        for element in page_elements:
             if element['text'] in seen:
                 continue
             else:
@@ -93,59 +167,209 @@ def create_doc_list(grouped_elements):
         document_list.append(new_entry)
     return document_list
 
-# Upload documents to Pinecone
-def create_vector_db(documents, index_name=settings.PINECONE_INDEX_NAME, vector_dimension=1536, batch_limit=100):
-    logger.info("Create vector database")
-    pinecone.init(environment=settings.PINECONE_ENVIRONMENT, api_key=settings.PINECONE_API_KEY)
-    embeddings = OpenAIEmbeddings()
+# Deterministic chunk id, re-indexing an unchanged chunk replaces it instead of adding a duplicate
+def chunk_id(source_url, chunk_index, text):
+    text_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    return hashlib.sha256(f"{source_url}\0{chunk_index}\0{text_hash}".encode("utf-8")).hexdigest()[:32]
+
+# Split documents into chunks of (id, text, metadata)
+def create_chunks(documents):
+    logger.info("Split documents into chunks")
     # Define text splitter
     text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=150)
-    # Setup Pinecone index
-    if index_name not in pinecone.list_indexes():
-        pinecone.create_index(
-            name=index_name,
-            metric='cosine',
-            dimension=vector_dimension
-        )
-    index = pinecone.Index(index_name)
-    texts = []
-    metadatas = []
-    logger.info("Insert documents into vector database")
-    # Iterate over documents and insert them into Pinecone step by step
-    for i, record in enumerate(documents):
+    chunks = []
+    for record in documents:
         metadata = record['metadata']
-        record_texts = text_splitter.split_text(record['text'])
-        record_metadatas = [{"chunk": j, "text": text, **metadata} for j, text in enumerate(record_texts)]
-        texts.extend(record_texts)
-        metadatas.extend(record_metadatas)
-        if len(texts) >= batch_limit:
-            # Create ID
-            ids = [str(uuid4()) for _ in range(len(texts))]
-            embeds = embeddings.embed_documents(texts)
-            index.upsert(vectors=zip(ids, embeds, metadatas))
-            texts = []
-            metadatas = []
-
-    if len(texts) > 0:
-        # Create ID
-        ids = [str(uuid4()) for _ in range(len(texts))]
-        embeds = embeddings.embed_documents(texts)
-        index.upsert(vectors=zip(ids, embeds, metadatas))
-    logger.info("Finished inserting embeddings to Pinecone")
-
-
-def main():
-    html_files = read_files_from_s3()
-    processed_html_files = html_preprocessing(html_files)
-    text_files = html_to_text(processed_html_files)
+        source_url = metadata.get('source-url', '')
+        for j, text in enumerate(text_splitter.split_text(record['text'])):
+            chunks.append((chunk_id(source_url, j, text), text, {"chunk": j, "text": text, **metadata}))
+    return chunks
+
+# Manifest of the chunk ids stored in the vector store, grouped by source url
+def manifest_path(backend):
+    return os.path.join(INDEX_MANIFEST_DIR, f"index_manifest_{backend}.json")
+
+def load_index_manifest(backend):
+    try:
+        with open(manifest_path(backend)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def save_index_manifest(backend, manifest):
+    path = manifest_path(backend)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(manifest, f)
+    os.replace(f"{path}.tmp", path)
+
+# Group chunks into embedding requests limited by token count and number of texts
+def create_batches(chunks, max_tokens=EMBEDDING_BATCH_TOKENS, max_texts=EMBEDDING_BATCH_SIZE):
+    encoding = tiktoken.encoding_for_model(settings.EMBEDDING_MODEL)
+    batches = []
+    batch, batch_tokens = [], 0
+    for chunk in chunks:
+        tokens = len(encoding.encode(chunk[1]))
+        if batch and (batch_tokens + tokens > max_tokens or len(batch) >= max_texts):
+            batches.append((batch, batch_tokens))
+            batch, batch_tokens = [], 0
+        batch.append(chunk)
+        batch_tokens += tokens
+    if batch:
+        batches.append((batch, batch_tokens))
+    return batches
+
+# Token bucket keeping the embedding requests of all workers within the tokens per minute limit
+class TokenRateLimiter:
+    def __init__(self, tokens_per_minute=settings.EMBEDDING_TOKENS_PER_MINUTE):
+        self.capacity = tokens_per_minute
+        self.rate = tokens_per_minute / 60
+        self.available = tokens_per_minute
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens):
+        tokens = min(tokens, self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.available >= tokens:
+                    self.available -= tokens
+                    return
+                wait_time = (tokens - self.available) / self.rate
+            time.sleep(wait_time)
+
+def embed_batch(batch, tokens, limiter):
+    limiter.acquire(tokens)
+    return openai_client.embed_texts([text for _, text, _ in batch])
+
+# Embed chunks with several requests in flight and upsert finished batches while the next ones are embedded.
+# Failed batches are retried without redoing successful ones, a batch whose upsert failed keeps its vectors
+# and is only upserted again. Returns the ids of chunks that still failed.
+def embed_and_upsert(index, chunks, workers=EMBEDDING_WORKERS, retries=EMBEDDING_RETRIES):
+    pending_embeds = create_batches(chunks)
+    pending_upserts = []
+    limiter = TokenRateLimiter()
+    failed_embeds, failed_upserts = [], []
+    with ThreadPoolExecutor(workers) as embed_pool, ThreadPoolExecutor(UPSERT_WORKERS) as upsert_pool:
+        for attempt in range(retries + 1):
+            if attempt > 0:
+                logger.info(f"Retry {len(pending_embeds)} failed embeddings and {len(pending_upserts)} failed upserts "
+                            f"(attempt {attempt + 1})")
+            embed_futures = {embed_pool.submit(embed_batch, batch, tokens, limiter): (batch, tokens)
+                             for batch, tokens in pending_embeds}
+            upsert_futures = {upsert_pool.submit(index.upsert, vectors): vectors for vectors in pending_upserts}
+            failed_embeds, failed_upserts = [], []
+            for future in as_completed(embed_futures):
+                batch, tokens = embed_futures[future]
+                try:
+                    embeds = future.result()
+                except Exception as e:
+                    logger.error(f"Embedding of {len(batch)} chunks failed: {e}")
+                    failed_embeds.append((batch, tokens))
+                    continue
+                vectors = [(vector_id, embed, metadata) for (vector_id, _, metadata), embed in zip(batch, embeds)]
+                upsert_futures[upsert_pool.submit(index.upsert, vectors)] = vectors
+            for future in as_completed(upsert_futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.error(f"Upsert of {len(upsert_futures[future])} chunks failed: {e}")
+                    failed_upserts.append(upsert_futures[future])
+            if not failed_embeds and not failed_upserts:
+                break
+            pending_embeds, pending_upserts = failed_embeds, failed_upserts
+    return ({vector_id for batch, _ in failed_embeds for vector_id, _, _ in batch}
+            | {vector_id for vectors in failed_upserts for vector_id, _, _ in vectors})
+
+# Upload new and changed chunks to the configured vector store, then delete chunks that no longer exist.
+# With complete=False some pages could not be read, the chunks of pages missing from documents are kept.
+def create_vector_db(documents, backend=settings.VECTOR_STORE_BACKEND, vector_dimension=1536,
+                     workers=EMBEDDING_WORKERS, complete=True):
+    logger.info(f"Create vector database ({backend})")
+    start = time.monotonic()
+    # Setup vector store, a missing Pinecone index is created with the given dimension
+    index = get_vector_store(backend, dimension=vector_dimension)
+    # Boilerplate shared between pages is only embedded once
+    chunks = remove_near_duplicates(create_chunks(documents))
+
+    previous = load_index_manifest(backend)
+    indexed_ids = {vector_id for ids in previous.values() for vector_id in ids}
+    current = {}
+    for vector_id, _, metadata in chunks:
+        current.setdefault(metadata.get('source-url', ''), []).append(vector_id)
+    new_chunks = [chunk for chunk in chunks if chunk[0] not in indexed_ids]
+    logger.info(f"{len(chunks)} chunks: {len(new_chunks)} new or changed, "
+                f"{len(chunks) - len(new_chunks)} unchanged")
+
+    # Only embed chunks that are not stored yet
+    logger.info("Insert chunks into vector database")
+    failed_ids = embed_and_upsert(index, new_chunks, workers=workers)
+
+    # Old chunks of a page are deleted once all its new chunks are stored, until then both stay in the
+    # manifest. Failed chunks are left out of it so that the next run embeds them again.
+    manifest = {}
+    stale_ids = []
+    for source, ids in current.items():
+        current_ids = set(ids)
+        old_ids = [vector_id for vector_id in previous.get(source, []) if vector_id not in current_ids]
+        stored_ids = [vector_id for vector_id in ids if vector_id not in failed_ids]
+        if len(stored_ids) < len(ids):
+            stored_ids += old_ids
+        else:
+            stale_ids += old_ids
+        manifest[source] = stored_ids
+    for source, ids in previous.items():
+        if source in current:
+            continue
+        if complete:
+            stale_ids += ids
+        else:
+            # The page may only have failed to download
+            manifest[source] = ids
+    if not complete:
+        logger.info("Not all pages were read, chunks of missing pages are kept")
+
+    logger.info(f"Delete {len(stale_ids)} chunks of changed and removed pages")
+    for i in range(0, len(stale_ids), 1000):
+        index.delete(stale_ids[i:i + 1000])
+    index.save()
+
+    save_index_manifest(backend, manifest)
+    # The keyword index is local and cheap to build, it is rebuilt from all chunks on every run
+    KeywordIndex().build(chunks)
+
+    elapsed = time.monotonic() - start
+    logger.info(f"Finished inserting {len(new_chunks) - len(failed_ids)} embeddings to the vector store ({backend}) "
+                f"in {elapsed:.1f} seconds, {len(failed_ids)} chunks failed")
+    if new_chunks or stale_ids:
+        mark_index_rebuilt(backend)
+
+
+def main(backend=settings.VECTOR_STORE_BACKEND, workers=PARTITION_WORKERS, embedding_workers=EMBEDDING_WORKERS):
+    failed_keys = []
+    html_files = read_files_from_s3(failed_keys=failed_keys)
+    text_files = html_to_text(html_files, workers=workers)
+    if failed_keys:
+        logger.error(f"{len(failed_keys)} pages could not be downloaded: {failed_keys}")
     grouped_elements = group_and_concat_elements(text_files)
     doc_list = create_doc_list(grouped_elements)
-    # user needs to confirm upload to Pinecone via console
-    if input(f"Upload {len(doc_list)} documents to Pinecone? (y/n)") == "y":
-        create_vector_db(doc_list)
+    # user needs to confirm upload to the vector store via console
+    if input(f"Upload {len(doc_list)} documents to {backend}? (y/n)") == "y":
+        create_vector_db(doc_list, backend=backend, workers=embedding_workers, complete=not failed_keys)
     else:
-        logger.info("Documents not uploaded to Pinecone")
+        logger.info(f"Documents not uploaded to {backend}")
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Build the vector index from the crawled TCW website")
+    parser.add_argument("--backend", choices=["pinecone", "local"], default=settings.VECTOR_STORE_BACKEND,
+                        help="vector store to write the embeddings to")
+    parser.add_argument("--workers", type=int, default=PARTITION_WORKERS,
+                        help="number of processes used to partition the HTML pages")
+    parser.add_argument("--embedding-workers", type=int, default=EMBEDDING_WORKERS,
+                        help="number of embedding requests in flight")
+    args = parser.parse_args()
+    main(backend=args.backend, workers=args.workers, embedding_workers=args.embedding_workers)
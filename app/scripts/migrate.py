@@ -0,0 +1,44 @@
+"""
+Create the tables, columns and indexes declared in app/database/models.py that do not exist in the database yet.
+Columns are added as nullable columns, existing columns are not altered. The script can be run repeatedly.
+
+Run from the project root:
+% python -m app.scripts.migrate
+"""
+
+import time
+
+from sqlalchemy import inspect, text
+
+from app.database import DatabaseManager
+from app.database.models import Base
+from app.core.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+def migrate(engine):
+    existing_tables = set(inspect(engine).get_table_names())
+    Base.metadata.create_all(engine, checkfirst=True)
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            logger.info(f"Created table {table.name}")
+            continue
+        existing_columns = {column["name"] for column in inspect(engine).get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing_columns:
+                column_type = column.type.compile(dialect=engine.dialect)
+                with engine.begin() as connection:
+                    connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+                logger.info(f"Added column {column.name} to {table.name}")
+        for index in table.indexes:
+            start = time.perf_counter()
+            # Emits CREATE INDEX only if the index does not exist yet
+            index.create(bind=engine, checkfirst=True)
+            logger.info(f"Index {index.name} on {table.name} is up to date ({time.perf_counter() - start:.1f} s)")
+
+
+if __name__ == "__main__":
+    db_manager = DatabaseManager()
+    migrate(db_manager.engine)
+    db_manager.close()
@@ -0,0 +1,14 @@
+from app.config import settings
+from .base import VectorStore
+from .keyword_index import KeywordIndex, reciprocal_rank_fusion
+from .local_store import LocalVectorStore
+
+
+# Create the vector store configured by VECTOR_STORE_BACKEND
+def get_vector_store(backend=settings.VECTOR_STORE_BACKEND, dimension=None):
+    if backend == "local":
+        return LocalVectorStore()
+    elif backend == "pinecone":
+        from .pinecone_store import PineconeVectorStore
+        return PineconeVectorStore(dimension=dimension)
+    raise ValueError(f"Unknown vector store backend: {backend}")
@@ -0,0 +1,23 @@
+from abc import ABC, abstractmethod
+
+
+# Interface of the vector stores used for retrieval. Query results follow the Pinecone response format:
+# {"matches": [{"id": ..., "score": ..., "metadata": {...}}, ...]}
+class VectorStore(ABC):
+
+    @abstractmethod
+    def query(self, vector, top_k=5, include_metadata=True):
+        raise NotImplementedError
+
+    # Insert or replace vectors given as (id, values, metadata) tuples
+    @abstractmethod
+    def upsert(self, vectors):
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete(self, ids):
+        raise NotImplementedError
+
+    # Persist pending changes, only required by local stores
+    def save(self):
+        pass
@@ -0,0 +1,122 @@
+import json
+import os
+import re
+from collections import Counter
+
+import numpy as np
+
+from app.config import settings
+from app.core.logger import get_logger
+from app.vectorstore.versioned import VersionedFiles, open_file
+
+logger = get_logger(__name__)
+
+STOPWORDS = {
+    "der", "die", "das", "und", "oder", "ist", "sind", "ein", "eine", "einen", "einem", "einer", "zu", "im", "in",
+    "mit", "von", "für", "auf", "an", "am", "den", "dem", "des", "es", "wie", "was", "wer", "ich", "sie", "wir",
+    "the", "a", "an", "and", "or", "is", "are", "of", "to", "in", "for", "on", "with", "what", "how", "who",
+}
+
+
+def tokenize(text):
+    return [token for token in re.findall(r"\w+", text.lower()) if token not in STOPWORDS]
+
+
+# Okapi BM25 index over the chunks of the vector store. Postings are stored in CSR layout in a .npz file,
+# ids and metadata of the chunks in a gzipped JSON file.
+class KeywordIndex:
+
+    def __init__(self, path=settings.KEYWORD_INDEX_PATH, k1=1.5, b=0.75):
+        self.path = path
+        self.arrays_path = os.path.join(path, "postings.npz")
+        self.meta_path = os.path.join(path, "chunks.json.gz")
+        self.k1 = k1
+        self.b = b
+        self._files = VersionedFiles(self.meta_path, self._read)
+        self._state = None
+        self._files.load()
+
+    def __len__(self):
+        return len(self._state["ids"]) if self._state else 0
+
+    # Build the index from chunks given as (id, text, metadata) and write it to disk
+    def build(self, chunks):
+        postings = {}
+        doc_lengths = []
+        for doc, (_, text, _) in enumerate(chunks):
+            tokens = tokenize(text)
+            doc_lengths.append(len(tokens))
+            for term, tf in Counter(tokens).items():
+                postings.setdefault(term, []).append((doc, tf))
+
+        terms = sorted(postings)
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(postings[term]) for term in terms])
+        docs = np.array([doc for term in terms for doc, _ in postings[term]], dtype=np.int32)
+        tfs = np.array([tf for term in terms for _, tf in postings[term]], dtype=np.uint16)
+
+        doc_lengths = np.array(doc_lengths, dtype=np.int32)
+        self._files.write([
+            (self.arrays_path, "wb",
+             lambda f: np.savez_compressed(f, offsets=offsets, docs=docs, tfs=tfs, doc_lengths=doc_lengths)),
+            (self.meta_path, "wt",
+             lambda f: json.dump({"terms": terms, "ids": [chunk[0] for chunk in chunks],
+                                  "metadata": [chunk[2] for chunk in chunks]}, f)),
+        ])
+        logger.info(f"Built keyword index with {len(chunks)} chunks and {len(terms)} terms")
+
+    def query(self, text, top_k=5):
+        self._files.reload_if_changed()
+        state = self._state
+        if not state or not state["ids"]:
+            return {"matches": []}
+        ids, doc_lengths = state["ids"], state["doc_lengths"]
+        scores = np.zeros(len(ids), dtype=np.float32)
+        avg_length = doc_lengths.mean() or 1.0
+        for term in set(tokenize(text)):
+            index = state["terms"].get(term)
+            if index is None:
+                continue
+            start, end = state["offsets"][index], state["offsets"][index + 1]
+            docs, tfs = state["docs"][start:end], state["tfs"][start:end].astype(np.float32)
+            idf = np.log(1 + (len(ids) - len(docs) + 0.5) / (len(docs) + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * doc_lengths[docs] / avg_length)
+            scores[docs] += idf * tfs * (self.k1 + 1) / (tfs + norm)
+
+        k = min(top_k, int(np.count_nonzero(scores)))
+        if k == 0:
+            return {"matches": []}
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return {"matches": [{"id": ids[i], "score": float(scores[i]), "metadata": state["metadata"][i]}
+                            for i in top]}
+
+    def _read(self):
+        with open_file(self.meta_path, "rt") as f:
+            meta = json.load(f)
+        arrays = np.load(self.arrays_path)
+        if len(meta["ids"]) != arrays["doc_lengths"].shape[0]:
+            logger.error(f"Keyword index at {self.path} is inconsistent, keeping previous version")
+            return False
+        self._state = {
+            "terms": {term: i for i, term in enumerate(meta["terms"])},
+            "ids": meta["ids"],
+            "metadata": meta["metadata"],
+            "offsets": arrays["offsets"],
+            "docs": arrays["docs"],
+            "tfs": arrays["tfs"],
+            "doc_lengths": arrays["doc_lengths"].astype(np.float32),
+        }
+        return True
+
+
+# Merge ranked result lists with reciprocal rank fusion
+def reciprocal_rank_fusion(results, top_k=5, k=60):
+    scores = {}
+    matches = {}
+    for result in results:
+        for rank, match in enumerate(result["matches"]):
+            scores[match["id"]] = scores.get(match["id"], 0.0) + 1.0 / (k + rank + 1)
+            matches.setdefault(match["id"], match)
+    ranked = sorted(scores, key=scores.get, reverse=True)[:top_k]
+    return {"matches": [{**matches[match_id], "score": scores[match_id]} for match_id in ranked]}
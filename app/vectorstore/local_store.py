@@ -0,0 +1,98 @@
+import json
+import os
+import threading
+
+import numpy as np
+
+from app.config import settings
+from app.core.logger import get_logger
+from app.vectorstore.base import VectorStore
+from app.vectorstore.versioned import VersionedFiles
+
+logger = get_logger(__name__)
+
+
+def normalize(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+# In-process vector store keeping normalized float32 vectors in a memory-mapped .npy file
+# and the ids and metadata of the rows in a JSON file next to it.
+class LocalVectorStore(VectorStore):
+
+    def __init__(self, path=settings.LOCAL_VECTOR_STORE_PATH):
+        self.path = path
+        self.vectors_path = os.path.join(path, "vectors.npy")
+        self.index_path = os.path.join(path, "index.json")
+        self._lock = threading.Lock()
+        self._files = VersionedFiles(self.index_path, self._read)
+        self._vectors = np.zeros((0, 0), dtype=np.float32)
+        self._ids = []
+        self._metadata = []
+        self._pending = {}
+        self._deleted = set()
+        self._files.load()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def query(self, vector, top_k=5, include_metadata=True):
+        if self._files.reload_if_changed():
+            logger.info(f"Loaded {len(self._ids)} vectors from {self.path}")
+        vectors, ids, metadata = self._vectors, self._ids, self._metadata
+        if not ids or top_k <= 0:
+            return {"matches": []}
+
+        # Cosine similarity of normalized vectors, only the top k rows are sorted
+        scores = vectors @ normalize(vector)
+        k = min(top_k, len(ids))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return {"matches": [{"id": ids[i],
+                             "score": float(scores[i]),
+                             "metadata": metadata[i] if include_metadata else {}}
+                            for i in top]}
+
+    # Changes are kept in memory until save() is called
+    def upsert(self, vectors):
+        with self._lock:
+            for vector_id, values, metadata in vectors:
+                self._pending[vector_id] = (normalize(values), metadata)
+                self._deleted.discard(vector_id)
+
+    def delete(self, ids):
+        with self._lock:
+            for vector_id in ids:
+                self._pending.pop(vector_id, None)
+                self._deleted.add(vector_id)
+
+    # Write the store to disk, readers never see a partial index
+    def save(self):
+        with self._lock:
+            keep = [i for i, vector_id in enumerate(self._ids)
+                    if vector_id not in self._deleted and vector_id not in self._pending]
+            ids = [self._ids[i] for i in keep] + list(self._pending)
+            metadata = [self._metadata[i] for i in keep] + [entry[1] for entry in self._pending.values()]
+            rows = [np.asarray(self._vectors[keep])] if keep else []
+            rows += [entry[0][np.newaxis, :] for entry in self._pending.values()]
+            vectors = np.vstack(rows).astype(np.float32) if rows else np.zeros((0, 0), dtype=np.float32)
+
+            self._files.write([
+                (self.vectors_path, "wb", lambda f: np.save(f, vectors)),
+                (self.index_path, "w", lambda f: json.dump({"ids": ids, "metadata": metadata}, f)),
+            ])
+            self._pending = {}
+            self._deleted = set()
+        logger.info(f"Saved {len(ids)} vectors to {self.path}")
+
+    def _read(self):
+        with open(self.index_path) as f:
+            index = json.load(f)
+        vectors = np.load(self.vectors_path, mmap_mode="r")
+        if len(index["ids"]) != vectors.shape[0]:
+            logger.error(f"Vector store at {self.path} is inconsistent, keeping previous version")
+            return False
+        self._vectors, self._ids, self._metadata = vectors, index["ids"], index["metadata"]
+        return True
@@ -0,0 +1,32 @@
+import pinecone
+
+from app.config import settings
+from app.core.logger import get_logger
+from app.vectorstore.base import VectorStore
+
+logger = get_logger(__name__)
+
+
+# Vector store backed by a remote Pinecone index
+class PineconeVectorStore(VectorStore):
+
+    def __init__(self, index_name=settings.PINECONE_INDEX_NAME, dimension=None):
+        pinecone.init(api_key=settings.PINECONE_API_KEY, environment=settings.PINECONE_ENVIRONMENT)
+        # Create the index on first use when the dimension is known, e.g. from the indexing script
+        if dimension is not None and index_name not in pinecone.list_indexes():
+            logger.info(f"Create Pinecone index {index_name}")
+            pinecone.create_index(name=index_name, metric='cosine', dimension=dimension)
+        self.index = pinecone.Index(index_name)
+
+    def query(self, vector, top_k=5, include_metadata=True):
+        results = self.index.query(vector, top_k=top_k, include_metadata=include_metadata)
+        return {"matches": [{"id": match["id"],
+                             "score": match["score"],
+                             "metadata": match["metadata"] if include_metadata else {}}
+                            for match in results["matches"]]}
+
+    def upsert(self, vectors):
+        self.index.upsert(vectors=list(vectors))
+
+    def delete(self, ids):
+        self.index.delete(ids=list(ids))
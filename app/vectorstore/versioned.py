@@ -0,0 +1,57 @@
+import gzip
+import os
+import threading
+
+
+# Files ending in .gz are compressed, target is the final path when writing to a temporary file
+def open_file(path, mode, target=None):
+    if (target or path).endswith(".gz"):
+        return gzip.open(path, mode, encoding="utf-8" if "t" in mode else None)
+    return open(path, mode, encoding="utf-8" if "b" not in mode else None)
+
+
+# Files of an index that are written by the indexing script and read by the API in another process.
+# Every file is replaced atomically and the marker file is written last, its modification time
+# identifies the version, so that readers never load a partially written index.
+class VersionedFiles:
+
+    # read() loads all files and returns False if they do not belong to the same version
+    def __init__(self, marker_path, read):
+        self.marker_path = marker_path
+        self.read = read
+        self.loaded_mtime = None
+        self._lock = threading.Lock()
+
+    # Write files given as (path, mode, write) tuples, write is called with the open file
+    def write(self, files):
+        for path, mode, write in sorted(files, key=lambda file: file[0] == self.marker_path):
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with open_file(f"{path}.tmp", mode, target=path) as f:
+                write(f)
+            os.replace(f"{path}.tmp", path)
+        self.load()
+
+    def load(self):
+        with self._lock:
+            return self._load()
+
+    # Pick up a new version written by the indexing script, returns True if one was loaded
+    def reload_if_changed(self):
+        try:
+            mtime = os.path.getmtime(self.marker_path)
+        except FileNotFoundError:
+            return False
+        if mtime == self.loaded_mtime:
+            return False
+        with self._lock:
+            return mtime != self.loaded_mtime and self._load()
+
+    def _load(self):
+        try:
+            mtime = os.path.getmtime(self.marker_path)
+            loaded = self.read()
+        except FileNotFoundError:
+            return False
+        if loaded:
+            self.loaded_mtime = mtime
+        return loaded